@@ -0,0 +1,104 @@
+import importlib
+import io
+import os
+import sys
+import time
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stderr, redirect_stdout
+from glob import glob
+
+# Batch mode for the formatting scripts -- runs a script's main function on many exports across a process pool
+#   - each file is run with the script's own arguments (--input_file and any other per-file arguments replaced), so outputs are named like single runs
+#   - one file failing (exception or parser error) doesn't stop the others, status of each file is reported as it finishes and again at the end
+#   - output of each file is captured and only shown for files that failed
+MAX_WORKERS = os.cpu_count() or 1
+BATCH_ARGUMENTS = ['--batch', '--workers'] # not passed on to each file's run
+
+
+# Input files from a folder (files with one of extensions, except those named like outputs) or a glob pattern
+#   - exclude, name suffixes (before extension) of files the script writes (so results of an earlier run aren't picked up as inputs)
+def get_batch_files(batch, extensions=('.csv',), exclude=()):
+    if os.path.isdir(batch):
+        files = [ os.path.join(batch, f) for f in os.listdir(batch) if f.lower().endswith(tuple(extensions)) ]
+    else:
+        files = glob(batch)
+
+    def is_output(f):
+        root = os.path.basename(f).split('.')[0]
+        return any(root.endswith(suffix) for suffix in exclude)
+    return sorted(f for f in files if os.path.isfile(f) and not is_output(f))
+
+
+# argv with flag's value set to value (added if not there) -- value of None removes flag and its value
+def replace_argument(argv, flag, value=None):
+    new_argv, skip = [], False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == flag:
+            skip = True
+        elif not arg.startswith(flag + '='):
+            new_argv.append(arg)
+    return new_argv + ([flag, value] if value is not None else [])
+
+
+# argv for one file of the batch (script's own argv with batch arguments removed and each flag in replacements set)
+def get_file_argv(argv, replacements):
+    for flag in BATCH_ARGUMENTS:
+        argv = replace_argument(argv, flag)
+    for flag, value in replacements.items():
+        argv = replace_argument(argv, flag, value)
+    return argv
+
+
+# Runs module's main function (same name as module) headless with argv, returns (status, seconds, captured output)
+def run_file(module_name, argv):
+    import redcap_common
+    redcap_common.OPEN_RESULTS = False # don't open every result in a spreadsheet program
+    main = getattr(importlib.import_module(module_name), module_name)
+
+    sys.argv = [module_name + '.py', '--headless'] + argv
+    output = io.StringIO()
+    start = time.perf_counter()
+    try:
+        with redirect_stdout(output), redirect_stderr(output):
+            main()
+        status = 'ok'
+    except SystemExit as e:
+        status = 'ok' if e.code in [None, 0] else 'failed (exit code {})'.format(e.code)
+    except Exception as e:
+        output.write(traceback.format_exc())
+        status = 'failed ({}: {})'.format(type(e).__name__, e)
+    return status, time.perf_counter() - start, output.getvalue()
+
+
+# Runs module's main function on each input file, returns number of files that failed
+#   - get_replacements, function(input_file) -> { flag: value } of per-file arguments (i.e. --input_file, --output_file)
+def run_batch(module_name, input_files, get_replacements, argv=None, workers=MAX_WORKERS):
+    if not input_files:
+        sys.stderr.write('No input files found for batch.\n')
+        return 1
+
+    argv = argv if argv is not None else [ arg for arg in sys.argv[1:] if arg not in ['--headless', '--ignore-gooey'] ]
+    print('### Processing {} files with {} workers ###'.format(len(input_files), min(workers, len(input_files))))
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = { executor.submit(run_file, module_name, get_file_argv(argv, get_replacements(input_file))): input_file for input_file in input_files }
+        for future in as_completed(futures):
+            input_file = futures[future]
+            try:
+                results[input_file] = future.result()
+            except Exception as e: # worker process died (i.e. ran out of memory)
+                results[input_file] = ('failed ({}: {})'.format(type(e).__name__, e), 0, '')
+            status, seconds, _ = results[input_file]
+            print('[{}/{}] {} -- {} ({:.1f}s)'.format(len(results), len(input_files), input_file, status, seconds))
+
+    failed = [ input_file for input_file in input_files if results[input_file][0] != 'ok' ]
+    for input_file in failed:
+        print('\n### Output for {} ###\n{}'.format(input_file, results[input_file][2].rstrip()))
+    print('\n### {} of {} files processed successfully ###'.format(len(input_files) - len(failed), len(input_files)))
+    for input_file in input_files:
+        print('{:<60} {}'.format(input_file, results[input_file][0]))
+    return len(failed)
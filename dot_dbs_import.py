@@ -1,4 +1,4 @@
-from gooey import Gooey, GooeyParser
+from gooey_common import Gooey, GooeyParser
 from os import chdir, getcwd, listdir
 from os.path import join, exists
 from stringcase import titlecase
@@ -81,4 +81,5 @@ def dot_dbs_import():
     return
 
 
-dot_dbs_import()
+if __name__ == '__main__':
+    dot_dbs_import()
@@ -2,7 +2,7 @@ import pandas as pd
 import re
 import redcap_common
 
-from gooey import Gooey, GooeyParser
+from gooey_common import Gooey, GooeyParser
 from os.path import basename, splitext
 
 def extract_form_fields(input_file, fields, merge=None, output_file=None):
@@ -2,7 +2,7 @@ import os
 import pandas as pd
 import redcap_common
 
-from gooey import Gooey, GooeyParser
+from gooey_common import Gooey, GooeyParser
 
 STATIC_FOLDER = r'//neuroimage.wustl.edu/nil/hershey/H/REDCap Scripts/static/'
 VARFILE_TEMPLATE = '{}_{}_column_map.csv'
@@ -1,13 +1,20 @@
-from gooey import Gooey, GooeyParser
+from gooey_common import Gooey, GooeyParser
+from sys import exit
 
+import batch_common
+import os
 import pandas as pd
+import redcap_cache
 import redcap_common
+import redcap_profile
 
 TRACK_STUDY_ID = 'track_id'
 TRACK_EXAM_DATE = 'physicalexam_date'
 
 RENAMES = [TRACK_STUDY_ID, None, None, TRACK_EXAM_DATE, None]
 DURATION_FIELDS = ['dob', 'db_dx_date', 'physicalexam_date']
+DX_TYPES = { 'db': { 'dx_date': 'db_dx_date', 'dx_age': 'db_onset_age' } }
+BATCH_OUTPUT_LABEL = '_formatted' # batch outputs are named <export>_formatted.csv
 
 @Gooey(default_size=(700,600))
 def format_track_data():
@@ -15,73 +22,99 @@ def format_track_data():
     parser = GooeyParser(description='Formats TRACK data from REDCap csv export')
 
     required = parser.add_argument_group('Required Arguments', gooey_options={'columns':1})
-    required.add_argument('--input_file', required=True, widget='FileChooser', help='REDCap export file')
-    required.add_argument('--output_file', required=True, widget='FileChooser', help='CSV file to store formatted data in')
-    required.add_argument('--api_password', required=True, widget='PasswordField', help='Password to access API token')
+    required.add_argument('--input_file', widget='FileChooser', help='REDCap export file')
+    required.add_argument('--output_file', widget='FileChooser', help='CSV file to store formatted data in (folder to write outputs to for --batch, default is next to each export)')
 
     optional = parser.add_argument_group('Optional Arguments', gooey_options={'columns':2})
+    optional.add_argument('--api_token', '--api_password', dest='api_token', widget='PasswordField', help='REDCap API token (only needed for --all/--any/--duration/--consecutive, asked for if not given)')
     optional.add_argument('-c', '--consecutive', type=int, metavar='num_consecutive_years', help='Limit results to particpants with data for a number of consecutive years')
     optional.add_argument('-d', '--duration', action='store_true', help='Calculate diabetes diagnosis duration')
+    optional.add_argument('--data_dictionary', widget='FileChooser', help='REDCap data dictionary csv (loads export with compact column types)')
+    optional.add_argument('--profile', action='store_true', help='Record time/memory for each processing stage (written next to output as <output>_profile.json/.csv)')
+    optional.add_argument('--clear_cache', action='store_true', help='Clear locally cached REDCap exports and pull everything from the API again')
+    optional.add_argument('--prune_deleted', action='store_true', help='Drop records deleted from REDCap from the local cache (exports every record id, so only needed now and then)')
+    optional.add_argument('--refresh_schema', action='store_true', help='Pull the data dictionary from REDCap again instead of using the local snapshot (cached exports are cleared if it changed)')
 
     variable_options = parser.add_argument_group('Variable options', 'Space-separated lists of data points (category, column prefix, and/or variable) participants must have data for in export', gooey_options={'columns':1, 'show_border':True})
     variable_options.add_argument('--all', nargs='+', default=None, help='All specified data points required for participant to be included in result')
     variable_options.add_argument('--any', nargs='+', default=None, help='At least one specified data point required for participant to be included in result')
 
+    batch_options = parser.add_argument_group('Batch options', 'Format every export in a folder (or matching a pattern) instead of a single input file -- each is written to <export>{}.csv with the same options'.format(BATCH_OUTPUT_LABEL), gooey_options={'columns':2, 'show_border':True})
+    batch_options.add_argument('--batch', widget='DirChooser', help='Folder of REDCap csv exports, or glob pattern (i.e. "exports/*_2019.csv")')
+    batch_options.add_argument('--workers', type=int, default=batch_common.MAX_WORKERS, help='Number of exports to format at once')
+
     format_options = parser.add_argument_group('Formatting options', gooey_options={'columns':2, 'show_border':True})
     format_options.add_argument('-e', '--expand', action='store_true', help='Arrange data with one row per subject per session')
     format_options.add_argument('-t', '--transpose', action='store_true', help='Transpose the data')
 
     args = parser.parse_args()
 
+    if args.batch:
+        input_files = batch_common.get_batch_files(args.batch, exclude=[BATCH_OUTPUT_LABEL, '_profile'])
+        get_output_file = lambda input_file: os.path.join(args.output_file or os.path.dirname(input_file), os.path.basename(redcap_common.strip_file_format(input_file)) + BATCH_OUTPUT_LABEL + '.csv')
+        failed = batch_common.run_batch('format_track_data', input_files, lambda input_file: { '--input_file': input_file, '--output_file': get_output_file(input_file) }, workers=args.workers)
+        exit(1 if failed else 0)
+    if not args.input_file or not args.output_file:
+        parser.error('--input_file and --output_file are required (unless formatting a --batch of exports)')
+
     if not args.input_file.endswith('.csv') or not args.output_file.endswith('.csv'):
         parser.error('Input and output files must be of type csv')
 
+    profiler = redcap_profile.Profiler(args.profile)
+
     # create initial dataframe structure
-    df = redcap_common.create_df(args.input_file)
-    df = df[df[TRACK_STUDY_ID].str.contains(r'TRACK\d+')] # remove test rows
+    with profiler.stage('load') as stage:
+        schema = redcap_cache.read_data_dictionary(args.data_dictionary) if args.data_dictionary else None
+        df = stage.output(redcap_common.create_df(args.input_file, schema, report=schema is not None))
 
-    project = None
-    if any(arg is not None for arg in [args.all, args.any, args.duration, args.consecutive]):
-        project = redcap_common.get_redcap_project('track', args.api_token)
+    with profiler.stage('filter', df) as stage:
+        df = stage.output(df[df[TRACK_STUDY_ID].str.contains(r'TRACK\d+')]) # remove test rows
 
-    if args.all:
-        df = redcap_common.check_for_all(df, args.all, project)
+    project = None
+    if args.all or args.any or args.duration or args.consecutive:
+        project = redcap_common.get_redcap_project('track', args.api_token, refresh_schema=args.refresh_schema)
+        if args.clear_cache:
+            redcap_cache.invalidate_cache(project)
 
-    if args.any:
-        df = redcap_common.check_for_any(df, args.any, project)
+    if args.all or args.any:
+        with profiler.stage('complete_rows', df) as stage:
+            df = stage.output(df[redcap_common.get_complete_rows(df, project, args.all, args.any)])
 
     fields = None
     if args.duration or args.consecutive:
-        fields = redcap_common.get_matching_columns(project.field_names, r'\w*(' + '|'.join(DURATION_FIELDS) + ')')
-        df = redcap_common.merge_api_data(df, project, fields, [TRACK_STUDY_ID])
+        field_names = list(redcap_cache.get_schema(project)['field_types'].keys())
+        fields = redcap_common.get_matching_columns(field_names, r'\w*(' + '|'.join(DURATION_FIELDS) + ')')
+        with profiler.stage('api_merge', df) as stage:
+            df = stage.output(redcap_common.merge_api_data(df, project, fields, [TRACK_STUDY_ID], prune_deleted=args.prune_deleted))
 
     # expand/rename after api merge to ensure column names match up
-    df, non_session_cols = redcap_common.expand(df.set_index(TRACK_STUDY_ID))
-    df = redcap_common.rename_common_columns(df, RENAMES, False)
+    with profiler.stage('expand', df) as stage:
+        df, non_session_cols = redcap_common.expand(df.set_index(TRACK_STUDY_ID))
+        df = redcap_common.rename_common_columns(df, RENAMES, False)
 
-    df[redcap_common.SESSION_DATE] = pd.to_datetime(df[redcap_common.SESSION_DATE])
-    df = df[pd.notnull(df[redcap_common.SESSION_DATE])] # remove rows for non-attended sessions
+        df[redcap_common.SESSION_DATE] = pd.to_datetime(df[redcap_common.SESSION_DATE])
+        df = df[pd.notnull(df[redcap_common.SESSION_DATE])] # remove rows for non-attended sessions
+        stage.output(df)
 
     if args.duration:
-        df = redcap_common.prepare_age_calc(df)
-        dx_vars = { 'dx_date': 'db_dx_date', 'dx_age': 'db_onset_age' }
-        df['db_dx_date'] = pd.to_datetime(df['db_dx_date'])
-        dx_age_df = df.loc[df[redcap_common.SESSION_NUMBER] == 's1'].apply(redcap_common.get_diagnosis_age, args=(dx_vars,), axis=1)
-        df = df.groupby([redcap_common.STUDY_ID]).apply(redcap_common.calculate_diagnosis_duration, 'db', dx_age_df)
-        df = df.drop('session_age', axis=1)
+        with profiler.stage('age_calc', df) as stage:
+            df = redcap_common.prepare_age_calc(df)
+            df['db_dx_date'] = pd.to_datetime(df['db_dx_date'])
+            df = redcap_common.add_diagnosis_durations(df, DX_TYPES)
+            df = stage.output(df.drop('session_age', axis=1))
 
     if args.consecutive:
-        df[redcap_common.SESSION_YEAR] = df[redcap_common.SESSION_DATE].apply(lambda x: x.year if x else None)
-        df = df.groupby([redcap_common.STUDY_ID]).apply(redcap_common.get_consecutive_years, args.consecutive)
-        df = df.drop([redcap_common.SESSION_YEAR], axis=1)
+        with profiler.stage('consecutive', df) as stage:
+            df[redcap_common.SESSION_YEAR] = df[redcap_common.SESSION_DATE].dt.year
+            df = df[redcap_common.get_consecutive_years_mask(df, args.consecutive)]
+            df = stage.output(df.drop([redcap_common.SESSION_YEAR], axis=1))
 
     df = redcap_common.rename_common_columns(df, RENAMES, True) # rename common columns back to original names pre-flattening
     df = df.set_index([TRACK_STUDY_ID, redcap_common.SESSION_NUMBER])
 
     if not args.expand:
-        non_session_cols = { col: 's1_' + col for col in df.columns if not re.match(r's\d_', col) }
-        df = df.rename(columns=non_session_cols)
-        df = redcap_common.flatten(df) # always reflatten at end, unless expand flag is set
+        with profiler.stage('flatten', df) as stage:
+            df = stage.output(redcap_common.simple_flatten(df)) # always reflatten at end, unless expand flag is set
 
 
     if args.transpose:
@@ -95,7 +128,10 @@ def format_track_data():
         drop_fields = fields if not args.expand else DURATION_FIELDS # if leaving expanded, then the columns we brought in don't match the current columns
         df = redcap_common.cleanup_api_merge(df, drop_fields)
 
-    redcap_common.write_results_and_open(df, args.output_file)
+    with profiler.stage('write', df):
+        redcap_common.write_results_and_open(df, args.output_file)
+    profiler.write(args.output_file)
 
 
-format_track_data()
+if __name__ == '__main__':
+    format_track_data()
@@ -1,10 +1,15 @@
+import batch_common
+import redcap_cache
 import redcap_common
+import redcap_profile
 
+import hashlib
 import numpy as np
+import os
 import pandas as pd
-import re
 
-from gooey import Gooey, GooeyParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from gooey_common import Gooey, GooeyParser
 from sys import exit, stderr
 
 # Redcap constants
@@ -17,13 +22,10 @@ RENAMES = [None, WFS_CLINIC_YEAR, None, 'clinic_date', WFS_SESSION_NUMBER]
 
 MRI_DATE = 'mri_date'
 MRI_AGE = 'mri_age'
+MRI_AGE_FILTER = '_mri_age' # age at MRI calculated only to drop non-MRI sessions (not written to outputs)
 
 def mri_age_calc(df):
-    df[MRI_DATE] = pd.to_datetime(df[MRI_DATE], errors='coerce')
-    df['dob'] = pd.to_datetime(df.groupby(['study_id'])['dob'].transform(lambda x: x.loc[x.first_valid_index()] if x.first_valid_index() is not None else np.nan)) # fills in dob for missing years using first-found dob for participant
-    mri_age_column = df.apply(lambda x: redcap_common.get_age(x['dob'], x[MRI_DATE]), axis=1)
-    df.insert(df.columns.get_loc(MRI_DATE), MRI_AGE, mri_age_column)
-    return df
+    return redcap_common.calculate_age(df, MRI_DATE, MRI_AGE)
 
 def select_best_age(row):
     if row['mri_age'] > 0:
@@ -31,15 +33,251 @@ def select_best_age(row):
     else:
         return row['session_age']
 
-def get_clinic_year_label(row):
-    clinic_year = row['redcap_event_name'][0:4]
-    if clinic_year == 'stab':
-        clinic_label = '0'
-    elif clinic_year == 'mini':
-        clinic_label = 'mc{}'.format(row['redcap_event_name'][12])
+
+# Rows used from export -- test/unneeded rows removed, common column names, events without arm suffix
+def select_rows(df):
+    df = df.drop(['redcap_repeat_instrument'], axis=1, errors="ignore")
+    df = df.drop(['redcap_repeat_instance'], axis=1, errors="ignore")
+    # df = df[df[WFS_STUDY_ID].str.contains(r'^(WOLF|SIB)_\d{4}_.+')] # remove Test and Wolf_AN rows
+    df = df[df[WFS_STUDY_ID].str.contains(r'^(WOLF|SIB|DT)')] # remove Test and Wolf_AN rows
+    df = df.rename(columns={WFS_SESSION_NUMBER: redcap_common.SESSION_NUMBER, WFS_STUDY_ID: redcap_common.STUDY_ID})
+    df['redcap_event_name'] = redcap_common.normalize_events(df['redcap_event_name'])
+    return df
+
+
+def get_export_info(df):
+    num_clinic_years = len(df['redcap_event_name'].unique())-1  # FIXME: should be counting max number of sessions for participants (still may cause error because they might not be consecutive)
+
+    # get number of subjects in dataframe
+    num_subjects = len(df[WFS_STUDY_ID].unique())
+    return { 'num_clinic_years': num_clinic_years, 'num_subjects': num_subjects }
+
+
+# remove rows for sessions not attended
+def clean_sessions(df):
+    df.loc[(df['redcap_event_name'] == 'stable'), [redcap_common.SESSION_NUMBER]] = df.loc[(df['redcap_event_name'] == 'stable'), [redcap_common.SESSION_NUMBER]].fillna(0)
+    # remove rows for sessions not attended (will have a flag saying they did not attend)
+    df = df[pd.notnull(df[redcap_common.SESSION_NUMBER])]
+    df = df[pd.isnull(df[MISSED_SESSION])]
+    df[redcap_common.SESSION_NUMBER] = df[redcap_common.SESSION_NUMBER].astype(int) # once NANs are gone, we can cast as int (nicer for flatten display)
+    return df
+
+
+# Normalized long frame -- selected rows of only attended sessions (returns dataframe and info about the export)
+def normalize(df):
+    df = select_rows(df)
+    return clean_sessions(df), get_export_info(df)
+
+
+def filter_consecutive(df, consecutive):
+    df[redcap_common.SESSION_YEAR] = redcap_common.map_events(df['redcap_event_name'], [redcap_common.SESSION_YEAR])[redcap_common.SESSION_YEAR] # stable and mini-clinic events are year-agnostic
+    df = df[redcap_common.get_consecutive_years_mask(df, consecutive)]
+    return df.drop([redcap_common.SESSION_YEAR], axis=1)
+
+
+# mri_age, add age at MRI for dropping non-MRI sessions (if export doesn't have mri_age) -- calculated before dob and MRI date are dropped
+def add_labels(df, mri_age=False):
+    if mri_age and MRI_AGE not in df.columns and MRI_DATE in df.columns and redcap_common.DOB in df.columns:
+        df = redcap_common.calculate_age(df, MRI_DATE, MRI_AGE_FILTER)
+
+    # add clinic_year
+    df['clinic_year'] = redcap_common.map_events(df['redcap_event_name'], ['clinic_year'])['clinic_year']
+
+    # rename common columns back to original names
+    df = redcap_common.rename_common_columns(df, RENAMES, True)
+
+    # rename session_age to clinic_age
+    df = df.rename(columns={"session_age": "clinic_age"})
+
+    # remove dob, clinic date and MRI date
+    df = df.drop(['dob'], axis=1, errors="ignore")
+    df = df.drop(['clinic_date'], axis=1, errors="ignore")
+    df = df.drop(['mri_date'], axis=1, errors="ignore")
+    df = df.drop(['redcap_event_name'], axis=1, errors="ignore")
+    return df
+
+
+def has_mri_age(df):
+    return MRI_AGE in df.columns or MRI_AGE_FILTER in df.columns
+
+
+# drop non-MRI sessions (clinic_year labels are text, stable is '0')
+def drop_non_mri_sessions(df):
+    mri_age = df[MRI_AGE] if MRI_AGE in df.columns else df[MRI_AGE_FILTER]
+    return df[(mri_age>0.0) | (df['clinic_year']=='0')]
+
+
+# flatten_by -> (column, output file label, column suffix prefix)
+FLATTEN_OPTIONS = {
+    'session number': ('wolfram_sessionnumber', '_flattened_by_session', 's'),
+    'clinic year': ('clinic_year', '_flattened_by_clinic', 'c'),
+}
+
+# Formats labeled long frame for output (new frame, df isn't modified so several outputs can be made from it)
+#   - flatten_by, puts all sessions/clinic years for a participant on one line (suffixed with year/session), None for long format
+#   - name, added to profile stage names (to tell outputs apart)
+def format_output(df, flatten_by=None, drop_non_mri=False, transpose=False, sort=False, profiler=None, name=''):
+    profiler = profiler or redcap_profile.Profiler()
+    if drop_non_mri:
+        with profiler.stage('drop_non_mri' + name, df) as stage:
+            df = stage.output(drop_non_mri_sessions(df))
+    df = df.drop(columns=[MRI_AGE_FILTER], errors='ignore')
+
+    if flatten_by:
+        # multi-index column for flattening
+        flatten_by_column, _, flatten_group_prefix = FLATTEN_OPTIONS[flatten_by]
+        with profiler.stage('flatten' + name, df) as stage:
+            df = stage.output(redcap_common.flatten(df, flatten_by_column, sort, flatten_group_prefix))
+
+    if transpose:
+        with profiler.stage('transpose' + name, df) as stage:
+            df = stage.output(df.transpose())
+    return df
+
+
+## Multi-variant output (--variants) -- several shapes of the export from one run, each written to <input>_<variant>.<format>
+# variant -> (flatten_by, drop_non_mri, transpose)
+OUTPUT_VARIANTS = {
+    'long': (None, False, False),
+    'flattened_by_session': ('session number', False, False),
+    'flattened_by_clinic': ('clinic year', False, False),
+    'just_mri': (None, True, False),
+    'transposed': ('session number', False, True),
+}
+MAX_WORKERS = 4
+
+# suffixes of files written by this script (skipped when looking for exports in a --batch folder)
+OUTPUT_LABELS = [ label for _, label, _ in FLATTEN_OPTIONS.values() ] + ['_just_mri', '_profile'] + [ '_' + variant for variant in OUTPUT_VARIANTS ]
+
+# Writes each variant of labeled long frame, returns output files (in variant order)
+#   - variants that only differ by transpose share one formatted frame (i.e. transposed is made from flattened_by_session)
+#   - independent variants are formatted/written concurrently (one at a time when profiling, so stage measurements don't overlap)
+def write_variants(df, variants, output_root, output_format, sort=False, profiler=None, max_workers=MAX_WORKERS):
+    profiler = profiler or redcap_profile.Profiler()
+    groups = {}
+    for variant in variants:
+        flatten_by, drop_non_mri, transpose = OUTPUT_VARIANTS[variant]
+        groups.setdefault((flatten_by, drop_non_mri), []).append((variant, transpose))
+
+    def write_group(flatten_by, drop_non_mri, members):
+        group_df = format_output(df, flatten_by, drop_non_mri, sort=sort, profiler=profiler, name=':' + members[0][0])
+        for variant, transpose in members:
+            variant_df = format_output(group_df, transpose=transpose, profiler=profiler, name=':' + variant)
+            with profiler.stage('write:' + variant, variant_df):
+                redcap_common.write_df(variant_df, '{}_{}.{}'.format(output_root, variant, output_format), output_format)
+
+    with ThreadPoolExecutor(max_workers=1 if profiler.enabled else max_workers) as executor:
+        futures = [ executor.submit(write_group, flatten_by, drop_non_mri, members) for (flatten_by, drop_non_mri), members in groups.items() ]
+        for future in as_completed(futures):
+            future.result()
+
+    output_files = [ '{}_{}.{}'.format(output_root, variant, output_format) for variant in variants ]
+    for output_file in output_files:
+        print('### Results written to {} ###'.format(output_file))
+    return output_files
+
+
+## Incremental mode (--incremental) -- only participants whose export rows changed since the last run of the same input file are reprocessed
+#   - a fingerprint (hash of their selected rows) is kept for each participant, along with the labeled long frame from the last run
+#   - rows of changed (or new) participants are reprocessed and patched into the previous long frame, participants no longer in the export are removed
+#   - every step up to the long frame works on each participant's rows independently, so the patched frame is the same as a full recompute
+#     (flatten depends on all participants, i.e. which columns are kept, so it is always run on the whole patched frame -- it's a single vectorized pass)
+ROW_RANK = '_row_rank' # position of row among participant's selected rows (used to place unchanged rows in the new export)
+
+def get_incremental_key(input_file, data_dictionary=None, consecutive=None, mri_age=False):
+    return redcap_cache.get_content_key('incremental', CACHE_VERSION, os.path.abspath(input_file), redcap_cache.hash_file(data_dictionary) if data_dictionary else None, consecutive, mri_age)
+
+
+def get_participant_ids(df):
+    return df[redcap_common.STUDY_ID].astype(str)
+
+
+def get_fingerprints(df):
+    row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    return { study_id: hashlib.sha1(row_hashes[rows].tobytes()).hexdigest()[:16] for study_id, rows in df.groupby(get_participant_ids(df), sort=False).indices.items() }
+
+
+# Everything done to participants' selected rows to make the labeled long frame
+def process_rows(df, consecutive=None, mri_age=False):
+    df = clean_sessions(df.copy())
+    if consecutive:
+        df = filter_consecutive(df, consecutive)
+    return add_labels(df, mri_age)
+
+
+# Labeled long frame for selected rows (see select_rows), reusing rows of unchanged participants from the last run -- returns (dataframe, number of participants reprocessed)
+def update_incremental(df, key, consecutive=None, mri_age=False):
+    fingerprints = get_fingerprints(df)
+    ids = get_participant_ids(df)
+    ranks = df.groupby(ids, sort=False).cumcount()
+
+    prev_df, prev_info = redcap_cache.read_cache(key)
+    if prev_df is not None and prev_info['columns'] == list(df.columns):
+        changed = [ study_id for study_id, fingerprint in fingerprints.items() if prev_info['fingerprints'].get(study_id) != fingerprint ]
     else:
-        clinic_label = '{}'.format(clinic_year)
-    return clinic_label
+        prev_df, changed = None, list(fingerprints.keys())
+
+    new_df = process_rows(df[ids.isin(changed)], consecutive, mri_age)
+    new_df[ROW_RANK] = ranks.loc[new_df.index]
+    if prev_df is not None:
+        prev_ids = get_participant_ids(prev_df)
+        kept = prev_df[prev_ids.isin(fingerprints.keys()) & ~prev_ids.isin(changed)]
+        positions = pd.Series(df.index, index=pd.MultiIndex.from_arrays([ids, ranks]))
+        kept.index = positions.reindex(pd.MultiIndex.from_arrays([get_participant_ids(kept), kept[ROW_RANK]])).to_numpy()
+        patched = pd.concat([kept, new_df]).sort_index(kind='stable')
+        for col in new_df.columns: # i.e. categories of id column in this export
+            if patched[col].dtype != new_df[col].dtype:
+                patched[col] = patched[col].astype(new_df[col].dtype)
+        new_df = patched
+
+    try:
+        redcap_cache.write_cache(key, new_df, { 'columns': list(df.columns), 'fingerprints': fingerprints })
+    except (ValueError, TypeError) as e: # columns parquet can't store (i.e. mixed types) -- next run reprocesses everyone
+        redcap_cache.remove_cache_entry(key)
+        print('### Could not cache incremental result ({}) ###'.format(e))
+    return new_df.drop(columns=[ROW_RANK]), len(changed)
+
+
+## Stage cache
+#   - output of each stage (before formatting) is cached with redcap_cache, keyed by a hash of the input file (and data dictionary)
+#     plus the options of that stage and every stage before it, so changing only formatting options (flatten/transpose/sort)
+#     starts from the cached long frame
+#   - bump CACHE_VERSION when what a stage produces changes, so old entries aren't used
+CACHE_VERSION = 5
+CACHED_STAGES = ['normalize', 'consecutive', 'label']
+
+def get_stage_keys(input_file, data_dictionary=None, consecutive=None, mri_age=False):
+    parts = [CACHE_VERSION, redcap_cache.hash_file(input_file), redcap_cache.hash_file(data_dictionary) if data_dictionary else None]
+    keys = {}
+    for stage, options in zip(CACHED_STAGES, [[], [consecutive], [mri_age]]):
+        parts = parts + [stage] + options
+        keys[stage] = redcap_cache.get_content_key(*parts)
+    return keys
+
+
+# Returns (dataframe, info, stages already done) for most processed stage in cache (or (None, {}, []) if none are)
+def read_cached_stage(keys):
+    for i in reversed(range(len(CACHED_STAGES))):
+        stage = CACHED_STAGES[i]
+        if stage not in keys:
+            continue
+        df, info = redcap_cache.read_cache(keys[stage])
+        if df is not None:
+            print('### Starting from cached {} stage ###'.format(stage))
+            return df, info, CACHED_STAGES[:i + 1]
+    return None, {}, []
+
+
+def cache_stage(profiler, keys, stage, df, info):
+    if stage not in keys:
+        return
+
+    with profiler.stage('cache_write', df):
+        try:
+            redcap_cache.write_cache(keys[stage], df, dict(info, stage=stage))
+        except (ValueError, TypeError) as e: # columns parquet can't store (i.e. mixed types)
+            redcap_cache.remove_cache_entry(keys[stage])
+            print('### Could not cache {} stage ({}) ###'.format(stage, e))
 
 
 @Gooey(default_size=(700,600))
@@ -47,117 +285,150 @@ def format_wolfram_data():
     # set up expected arguments and associated help text
     parser = GooeyParser(description='Formats Wolfram data from REDCap csv export\n********************\nNOTE: Input REDCap file must contain both stable (e.g. sex) and clinic-year data, and also include wolfram_sessionnumber.\n********************')
     required = parser.add_argument_group('Required Arguments', gooey_options={'columns':1})
-    required.add_argument('--input_file', required=True, widget='FileChooser', gooey_options={'wildcard':"Comma separated file (*.csv)|*.csv|"}, help='REDCap-exported csv file')
+    required.add_argument('--input_file', widget='FileChooser', gooey_options={'wildcard':"Comma separated file (*.csv)|*.csv|Compressed csv (*.gz;*.zst)|*.gz;*.zst|Columnar file (*.parquet;*.feather)|*.parquet;*.feather|"}, help='REDCap-exported csv file')
     # required.add_argument('--output_file', required=True, widget='FileChooser', help='CSV file to store formatted data in')
 
     optional = parser.add_argument_group('Optional Arguments', gooey_options={'columns':1})
     optional.add_argument('-c', '--consecutive', type=int, metavar='num_consecutive_years', help='Limit results to particpants with data for a number of consecutive years')
     optional.add_argument('--drop_non_mri', action='store_true', help='Drop all sessions that do not have an "mri_date" entry.')
+    optional.add_argument('--data_dictionary', widget='FileChooser', help='REDCap data dictionary csv (loads export with compact column types)')
+    optional.add_argument('--no_cache', action='store_true', help='Recompute every stage instead of starting from cached intermediate results (cached in {})'.format(redcap_cache.CACHE_DIR))
+    optional.add_argument('--incremental', action='store_true', help='Only reprocess participants whose rows changed since the last run on this input file')
+    optional.add_argument('--verify', action='store_true', help='With --incremental, check result against a full recompute (exits with an error if they differ)')
+    optional.add_argument('--profile', action='store_true', help='Record time/memory for each processing stage (written next to output as <output>_profile.json/.csv)')
     # optional.add_argument('--api_token', widget='PasswordField', help='REDCap API token (if not specified, will not pull anything from REDCap)')
 
     # variable_options = parser.add_argument_group('Variable options', 'Space-separated lists of data points (category, column prefix, and/or variable) participants must have data for in export', gooey_options={'columns':1, 'show_border':True})
     # variable_options.add_argument('--all', nargs='+', default=None, help='All specified data points required for participant to be included in result')
     # variable_options.add_argument('--any', nargs='+', default=None, help='At least one specified data point required for participant to be included in result')
 
+    batch_options = parser.add_argument_group('Batch options', 'Format every export in a folder (or matching a pattern) instead of a single input file -- each is written with the same options and output naming', gooey_options={'columns':2, 'show_border':True})
+    batch_options.add_argument('--batch', widget='DirChooser', help='Folder of REDCap csv exports, or glob pattern (i.e. "exports/*_2019.csv")')
+    batch_options.add_argument('--workers', type=int, default=batch_common.MAX_WORKERS, help='Number of exports to format at once')
+
     format_options = parser.add_argument_group('Formatting options', gooey_options={'columns':2, 'show_border':True})
     format_options.add_argument('-f', '--flatten', action='store_true', help='Arrange all session data in single row for participant')
     format_options.add_argument('--flatten_by', default='session number', choices=['session number', 'clinic year'], help='Flatten data by session number or clinic year')
     format_options.add_argument('-t', '--transpose', action='store_true', help='Transpose the data')
+    format_options.add_argument('--output_format', choices=redcap_common.FILE_FORMATS, help='Format for output file (default is same as input file)')
+    format_options.add_argument('--variants', nargs='+', choices=list(OUTPUT_VARIANTS.keys()), widget='Listbox', help='Write several output shapes from one run (to <input>_<variant> files) instead of the one chosen by the options above')
     format_options.add_argument('-s', '--sort_by', default='variable', choices=['variable', 'session/clinic'], help='Sort flattened data by session or variable')
 
     args = parser.parse_args()
+    if args.variants and (args.flatten or args.transpose or args.drop_non_mri):
+        parser.error('--variants cannot be combined with --flatten, --transpose or --drop_non_mri (each variant sets its own)')
+
+    if args.verify and not args.incremental:
+        parser.error('--verify only applies to --incremental runs')
+
+    if args.batch:
+        input_files = batch_common.get_batch_files(args.batch, exclude=OUTPUT_LABELS)
+        failed = batch_common.run_batch('format_wolfram_data', input_files, lambda input_file: { '--input_file': input_file }, workers=args.workers)
+        exit(1 if failed else 0)
+    if not args.input_file:
+        parser.error('--input_file is required (unless formatting a --batch of exports)')
 
     dur_label = ''
     flatten_label = ''
     mri_label = ''
 
-    if not args.input_file.endswith('.csv'):
-        parser.error('ERROR: Input file must be a csv exported from REDCap')
-
-    # create dataframe from REDCap data
-    df = redcap_common.create_df(args.input_file)
-    df = df.drop(['redcap_repeat_instrument'], axis=1, errors="ignore")
-    df = df.drop(['redcap_repeat_instance'], axis=1, errors="ignore")
-    # df = df[df[WFS_STUDY_ID].str.contains(r'^(WOLF|SIB)_\d{4}_.+')] # remove Test and Wolf_AN rows
-    df = df[df[WFS_STUDY_ID].str.contains(r'^(WOLF|SIB|DT)')] # remove Test and Wolf_AN rows
-    df = df.rename(columns={WFS_SESSION_NUMBER: redcap_common.SESSION_NUMBER, WFS_STUDY_ID: redcap_common.STUDY_ID})
-    arm_tail_pattern = re.compile(r'_arm_.')
-    df['redcap_event_name'] = df['redcap_event_name'].str.replace(arm_tail_pattern,'', regex=True)
-    num_clinic_years = len(df['redcap_event_name'].unique())-1  # FIXME: should be counting max number of sessions for participants (still may cause error because they might not be consecutive)
-    print('### Number of clinic years detected in file = {} ###'.format(num_clinic_years))
-
-    # get number of subjects in dataframe
-    num_subjects = len(df[WFS_STUDY_ID].unique())
-    print('### Number of subjects detected in {} = {} ###'.format(args.input_file,num_subjects))
-
-    if args.consecutive is not None and args.consecutive not in range(2, num_clinic_years + 1):
-        parser.error('Consecutive years must be greater than 1 and cannot exceed number of clinic years ({})'.format(num_clinic_years))
-
-    df.loc[(df['redcap_event_name'] == 'stable'), [redcap_common.SESSION_NUMBER]] = df.loc[(df['redcap_event_name'] == 'stable'), [redcap_common.SESSION_NUMBER]].fillna(0)
-    # remove rows for sessions not attended (will have a flag saying they did not attend)
-    df = df[pd.notnull(df[redcap_common.SESSION_NUMBER])]
-    df = df[pd.isnull(df[MISSED_SESSION])]
-    df[redcap_common.SESSION_NUMBER] = df[redcap_common.SESSION_NUMBER].astype(int) # once NANs are gone, we can cast as int (nicer for flatten display)
+    input_format = redcap_common.get_file_format(args.input_file)
+    if input_format == 'csv' and not args.input_file.endswith('.csv'):
+        parser.error('ERROR: Input file must be a csv exported from REDCap (or a {} file)'.format('/'.join(redcap_common.FILE_FORMATS[1:])))
+
+    profiler = redcap_profile.Profiler(args.profile)
+    mri_age = args.drop_non_mri or 'just_mri' in (args.variants or []) # only calculated when an output drops non-MRI sessions
+
+    # start from the most processed cached stage (if any)
+    with profiler.stage('cache_read') as stage:
+        keys = get_stage_keys(args.input_file, args.data_dictionary, args.consecutive, mri_age) if not args.no_cache and not args.incremental else {}
+        df, info, done = read_cached_stage(keys)
+        stage.output(df)
+
+    if 'normalize' not in done:
+        # create dataframe from REDCap data
+        with profiler.stage('load') as stage:
+            schema = redcap_cache.read_data_dictionary(args.data_dictionary) if args.data_dictionary else None
+            df = stage.output(redcap_common.create_df(args.input_file, schema, report=schema is not None))
+
+        with profiler.stage('filter', df) as stage:
+            if args.incremental: # rest of normalization is done per participant (see update_incremental)
+                df = select_rows(df)
+                info = get_export_info(df)
+            else:
+                df, info = normalize(df)
+            stage.output(df)
+        cache_stage(profiler, keys, 'normalize', df, info)
+
+    print('### Number of clinic years detected in file = {} ###'.format(info['num_clinic_years']))
+    print('### Number of subjects detected in {} = {} ###'.format(args.input_file, info['num_subjects']))
 
     # if varaibles are specified, filter out rows that don't have data for them (if null or non-numeric)
-    # if args.all:
-    #    df = redcap_common.check_for_all(df, args.all, project, True)
-    # if args.any:
-    #    df = redcap_common.check_for_any(df, args.any, project, True)
+    # if args.all or args.any:
+    #    df = df[redcap_common.get_complete_rows(df, project, args.all, args.any, True)]
 
     # remove session data for participants that did not occur in consecutive years
-    if args.consecutive:
-        df = df.groupby([redcap_common.STUDY_ID]).apply(redcap_common.get_consecutive_years, args.consecutive)
+    if args.consecutive and 'consecutive' not in done:
+        if args.consecutive not in range(2, info['num_clinic_years'] + 1):
+            parser.error('Consecutive years must be greater than 1 and cannot exceed number of clinic years ({})'.format(info['num_clinic_years']))
+
+        if not args.incremental:
+            with profiler.stage('consecutive', df) as stage:
+                df = stage.output(filter_consecutive(df, args.consecutive))
+            cache_stage(profiler, keys, 'consecutive', df, info)
+
+    if args.incremental:
+        with profiler.stage('incremental', df) as stage:
+            selected_df = df
+            df, num_changed = update_incremental(selected_df, get_incremental_key(args.input_file, args.data_dictionary, args.consecutive, mri_age), args.consecutive, mri_age)
+            stage.output(df)
+        print('### Reprocessed {} of {} participants ###'.format(num_changed, info['num_subjects']))
+
+        if args.verify:
+            with profiler.stage('verify', df):
+                try:
+                    pd.testing.assert_frame_equal(df, process_rows(selected_df, args.consecutive, mri_age))
+                except AssertionError as e:
+                    stderr.write('Incremental result does not match full recompute:\n{}\n'.format(e))
+                    exit(1)
+            print('### Incremental result matches full recompute ###')
+        done = CACHED_STAGES
 
     if df.empty:
         stderr.write('No data to return. Selections have filtered out all rows.')
         exit(1)
 
-    # add clinic_year
-    df['clinic_year'] = df.apply(lambda row: get_clinic_year_label(row), axis = 1)
-
-    # rename common columns back to original names
-    df = redcap_common.rename_common_columns(df, RENAMES, True)
+    if 'label' not in done:
+        with profiler.stage('label', df) as stage:
+            df = stage.output(add_labels(df, mri_age))
+        cache_stage(profiler, keys, 'label', df, info)
 
-    # rename session_age to clinic_age
-    df = df.rename(columns={"session_age": "clinic_age"})
+    if mri_age and not has_mri_age(df):
+        stderr.write('Cannot drop non-MRI sessions: export needs "{}" and "{}" columns to calculate "{}".'.format(MRI_DATE, redcap_common.DOB, MRI_AGE))
+        exit(1)
 
-    # remove dob, clinic date and MRI date
-    df = df.drop(['dob'], axis=1, errors="ignore")
-    df = df.drop(['clinic_date'], axis=1, errors="ignore")
-    df = df.drop(['mri_date'], axis=1, errors="ignore")
-    df = df.drop(['redcap_event_name'], axis=1, errors="ignore")
+    output_format = args.output_format or input_format
+    sort = args.sort_by == 'session'
+    if args.variants:
+        output_root = redcap_common.strip_file_format(args.input_file)
+        write_variants(df, args.variants, output_root, output_format, sort, profiler)
+        profiler.write('{}_variants.{}'.format(output_root, output_format))
+        return
 
-    # drop non-MRI sessions
     if args.drop_non_mri:
-        df = df[(df[MRI_AGE]>0.0) | (df['clinic_year']==0)]
         mri_label = '_just_mri'
 
-    # puts all sessions/clinic years for a participant on one line (suffixed with year/session)
-    if args.flatten:
-        # multi-index column for flattening
-        if args.flatten_by == 'session number':
-            flatten_by_column = 'wolfram_sessionnumber'
-            flatten_label = '_flattened_by_session'
-            # df.set_index([redcap_common.STUDY_ID, redcap_common.SESSION_NUMBER], inplace=True)
-            flatten_group_prefix = 's'
-        elif args.flatten_by == 'clinic year':
-            flatten_by_column = 'clinic_year'
-            flatten_label = '_flattened_by_clinic'
-            # df.set_index([redcap_common.STUDY_ID, 'clinic_year'], inplace=True)
-            flatten_group_prefix = 'c'
-        else:
-            raise Exception('ERROR: flatten_by check failed')
-
-        sort = args.sort_by == 'session'
-        df = redcap_common.flatten(df, flatten_by_column, sort, flatten_group_prefix)
-
-    if args.transpose:
-        df = df.transpose()
+    flatten_by = args.flatten_by if args.flatten else None
+    if flatten_by:
+        flatten_label = FLATTEN_OPTIONS[flatten_by][1]
+    df = format_output(df, flatten_by, args.drop_non_mri, args.transpose, sort, profiler)
 
     # make output_file name
-    output_file = args.input_file.replace('.csv','{}{}{}.csv'.format(dur_label, flatten_label, mri_label))
+    output_file = '{}{}{}{}.{}'.format(redcap_common.strip_file_format(args.input_file), dur_label, flatten_label, mri_label, output_format)
 
-    redcap_common.write_results_and_open(df, output_file)
+    with profiler.stage('write', df):
+        redcap_common.write_results_and_open(df, output_file, output_format)
+    profiler.write(output_file)
 
-format_wolfram_data()
+if __name__ == '__main__':
+    format_wolfram_data()
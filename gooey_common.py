@@ -0,0 +1,68 @@
+import os
+import sys
+
+from argparse import ArgumentParser
+from functools import wraps
+
+# Drop-in replacements for gooey.Gooey/GooeyParser that only import Gooey (and wx) when the GUI is actually shown
+#   - scripts run headless (plain argparse) when given --headless (or Gooey's own --ignore-gooey), or when REDCAP_HEADLESS is set
+#   - gooey-only keyword arguments (widget, gooey_options) are dropped in headless mode
+#   - only Gooey/wx are deferred here -- scripts still import numpy/pandas at module level, which is most of their startup time
+#     (see tools/startup_time.py)
+HEADLESS_FLAGS = ['--headless', '--ignore-gooey']
+GOOEY_KWARGS = ['widget', 'gooey_options']
+
+
+def is_headless():
+    return any(flag in sys.argv[1:] for flag in HEADLESS_FLAGS) or bool(os.environ.get('REDCAP_HEADLESS'))
+
+
+def strip_gooey_kwargs(kwargs):
+    return { key: value for key, value in kwargs.items() if key not in GOOEY_KWARGS }
+
+
+# Makes add_argument on parser/group ignore gooey-only keyword arguments
+def strip_gooey_arguments(container):
+    add_argument = container.add_argument
+    container.add_argument = lambda *args, **kwargs: add_argument(*args, **strip_gooey_kwargs(kwargs))
+    return container
+
+
+class HeadlessParser(ArgumentParser):
+    def __init__(self, **kwargs):
+        super().__init__(**strip_gooey_kwargs(kwargs))
+        strip_gooey_arguments(self)
+
+    def add_argument_group(self, *args, **kwargs):
+        return strip_gooey_arguments(super().add_argument_group(*args, **strip_gooey_kwargs(kwargs)))
+
+    def add_mutually_exclusive_group(self, **kwargs):
+        return strip_gooey_arguments(super().add_mutually_exclusive_group(**strip_gooey_kwargs(kwargs)))
+
+    def parse_known_args(self, args=None, namespace=None):
+        if args is None:
+            args = [ arg for arg in sys.argv[1:] if arg not in HEADLESS_FLAGS ]
+        return super().parse_known_args(args, namespace)
+
+
+def GooeyParser(**kwargs):
+    if is_headless():
+        return HeadlessParser(**kwargs)
+
+    from gooey import GooeyParser
+    return GooeyParser(**kwargs)
+
+
+# Usable as @Gooey or @Gooey(**gooey_options), like gooey.Gooey (whether to show GUI is decided when function is called)
+def Gooey(f=None, **gooey_kwargs):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if is_headless():
+                return func(*args, **kwargs)
+
+            from gooey import Gooey
+            return Gooey(**gooey_kwargs)(func)(*args, **kwargs)
+        return wrapper
+
+    return decorator(f) if callable(f) else decorator
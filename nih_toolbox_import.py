@@ -1,10 +1,18 @@
-from gooey import Gooey, GooeyParser
-from os import listdir
-from os.path import join, exists
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+from gooey_common import Gooey, GooeyParser
+from os import listdir, makedirs
+from os.path import abspath, basename, dirname, join, exists
 
+import batch_common
+import hashlib
+import json
+import os
 import pandas as pd
 import numpy as np
+from pandas.api.extensions import take
 import re
+import redcap_cache
 import redcap_common
 
 COG_FOLDER = 'H:\\NEWT\\Data\\Cognitive'
@@ -34,9 +42,23 @@ subject_vars = {
 	'Neuro-QoL': 'self_neuroqol'
 }
 
-def replace_variables(df, var_map):
-	renames = { inst: v for k,v in var_map.items() for inst in df['Inst'] if k in inst }
-	return df.replace(list(renames.keys()), list(renames.values()))
+VAR_MAPS = { 'parent': parent_vars, 'subject': subject_vars }
+MIN_SUBJECT_ROWS = 5 # PINs with fewer rows only have the parent instruments (parent names are used for them)
+
+
+# Variable name for instrument (last key of var map found in instrument name, unmatched instruments keep their name)
+#   - cached, so each instrument name is only matched once per run (across all exports)
+@lru_cache(maxsize=None)
+def match_instrument(inst, var_map_name):
+	matches = [ v for k,v in VAR_MAPS[var_map_name].items() if k in inst ]
+	return matches[-1] if matches else inst
+
+
+# Renamed Inst column -- unique instrument names are matched, then mapped back to rows through categorical codes
+def replace_variables(insts, var_map_name):
+	insts = insts.astype('category')
+	names = np.array([ match_instrument(inst, var_map_name) for inst in insts.cat.categories ], dtype=object)
+	return pd.Series(take(names, insts.cat.codes.to_numpy(), allow_fill=True), index=insts.index, name=insts.name)
 
 
 def get_session_number(pin):
@@ -44,58 +66,188 @@ def get_session_number(pin):
 	return session.group().lower() if session else '1'
 
 
+PIN_PATTERN = re.compile(r'(?P<newt_id>\w{0,4} ?\d{1,4})?(?:_| |-)?(?:s?)?(?P<session_number>\d?)', flags=re.IGNORECASE)
+
+
+# (newt_id, session number) for a PIN -- newt_id is None if PIN doesn't parse, session defaults to '1'
+#   - cached, so each PIN is only parsed once per run (the same PIN is on every instrument row)
+@lru_cache(maxsize=None)
+def parse_pin(pin):
+	newt_id, session_number = PIN_PATTERN.search(pin).groups()
+	newt_id = newt_id.replace(' ', '').upper() if newt_id is not None else None
+	session_number = session_number.lower() if session_number and session_number.strip() else '1'
+	return newt_id, session_number
+
+
+# Replaces PIN (newt_id column) with id and adds session_number -- unique PINs are parsed, then mapped back to rows through categorical codes
+#   - rows with PINs that don't parse are dropped, returns (dataframe, PINs that didn't parse)
 def extract_id_and_session(df):
-	# df['session_number'] = df['newt_id'].apply(get_session_number)
-	# df['newt_id'] = df['newt_id'].apply(lambda x: re.match('(NEWT *\d{3}?)', x, flags=re.IGNORECASE).group().upper().replace(' ', ''))
-	# print('newt_id = {}'.format(df['newt_id']))
-	df[['newt_id', 'session_number']] = df['newt_id'].str.extract(r'(?P<newt_id>\w{0,4} ?\d{1,4})?(?:_| |-)?(?:s?)?(?P<session_number>\d?)', flags=re.IGNORECASE)
-	df['newt_id'] = df['newt_id'].apply(lambda x: x.replace(' ', '').upper())
-	df['session_number'] = df['session_number'].replace(r'^\s*$', np.NaN, regex=True).fillna('1').str.lower()
+	pins = df['newt_id'].astype('category')
+	parsed = [ parse_pin(str(pin)) for pin in pins.cat.categories ]
+	newt_ids = np.array([ newt_id for newt_id, _ in parsed ], dtype=object)
+	session_numbers = np.array([ session_number for _, session_number in parsed ], dtype=object)
+	codes = pins.cat.codes.to_numpy()
+	df = df.assign(newt_id=take(newt_ids, codes, allow_fill=True), session_number=take(session_numbers, codes, allow_fill=True, fill_value='1'))
+
+	invalid = df['newt_id'].isnull()
+	invalid_pins = sorted(str(pin) for pin in pins[invalid].dropna().unique()) # (missing PINs aren't PINs that didn't parse)
 	# df.to_csv('after_replace_s1.csv')
-	return df
+	return df[~invalid], invalid_pins
+
+
+# Parses one toolbox export into subject/parent rows with ids and session numbers -- returns (dataframe, messages to show, PINs that didn't parse)
+#   - dataframe is None if export was skipped
+def process_export(export_file):
+	messages, invalid_pins = [], []
+	export = basename(export_file)
+	df = pd.read_csv(export_file).dropna(how='all')
+	if UNADJUSTED not in df.columns:
+		messages.append('WARNING: SKIPPING "{}", Column named "{}" not found'.format(export,UNADJUSTED))
+		return None, messages, invalid_pins
+
+	# df.to_csv('df_before_rename.csv')
+	df = df.rename(columns={'PIN': 'newt_id',  'RawScore': 'raw', 'TScore': 'tscore'})
+
+	# rows without a PIN can't be matched to anyone (reported separately from PINs that don't parse)
+	missing_pin = df['newt_id'].isnull()
+	if missing_pin.any():
+		messages.append('WARNING: {} row(s) in "{}" have no PIN, they were dropped'.format(missing_pin.sum(), export))
+		df = df[~missing_pin]
+
+	# check for S2 mismatch
+	if ( 'S2' in export.upper()):
+		S2_mismatch = True in ( 'S2' not in newt_id.upper() for newt_id in df['newt_id'].drop_duplicates().tolist() )
+		if S2_mismatch:
+			messages.append('WARNING: S2 mismatch detected in "{}", check csv file'.format(export))
+
+	# df.to_csv('df_after_rename.csv')
+	parent_df = df[df['newt_id'].str.contains('parent', flags=re.IGNORECASE)]
+	# parent_df.to_csv('parent_df.csv')
+	subject_df = df[~df['newt_id'].isin(parent_df['newt_id'])]
+
+	if not parent_df.empty:
+		parent_df = parent_df.assign(Inst=replace_variables(parent_df['Inst'], 'parent'))
+		parent_df, invalid_parent_pins = extract_id_and_session(parent_df)
+		invalid_pins += invalid_parent_pins
+		# print(export, " contains parent data")
+	else:
+		parent_df = None
+
+	if not subject_df.empty:
+		is_subject = subject_df.groupby('newt_id')['newt_id'].transform('size') >= MIN_SUBJECT_ROWS
+		subject_df = subject_df.assign(Inst=replace_variables(subject_df['Inst'], 'subject').where(is_subject, replace_variables(subject_df['Inst'], 'parent')))
+		# subject_df.to_csv('subject_df_before_extract.csv')
+		subject_df, invalid_subject_pins = extract_id_and_session(subject_df)
+		invalid_pins += invalid_subject_pins
+	else:
+		subject_df = None
+
+	invalid_pins = sorted(invalid_pins)
+	if invalid_pins:
+		messages.append('WARNING: {} PIN(s) in "{}" could not be parsed, their rows were dropped: {}'.format(len(invalid_pins), export, ', '.join(invalid_pins)))
+	return pd.concat([subject_df, parent_df], axis=0), messages, invalid_pins
+
 
+## Incremental folder ingestion
+#   - manifest (per exports folder, kept in the REDCap cache folder) records size, mtime and content hash of each export and whether it was skipped
+#   - parsed exports are cached by content hash (see redcap_cache), so exports that haven't changed are read back instead of parsed again
+#     (content is only re-hashed when size or mtime changed)
+#   - new/changed exports are parsed in a process pool
+PARSE_VERSION = 3 # bump when process_export changes what it produces, so cached exports are parsed again
 
-def nih_toolbox_import(exports_folder, subjects):
-	result = None
+def get_manifest_file(exports_folder):
+	return join(redcap_cache.CACHE_DIR, 'nih_manifest_{}.json'.format(hashlib.sha1(abspath(exports_folder).encode()).hexdigest()[:16]))
+
+
+def get_export_key(content_hash):
+	return redcap_cache.get_content_key('nih_toolbox', PARSE_VERSION, content_hash)
+
+
+def read_manifest(manifest_file):
+	if not exists(manifest_file):
+		return {}
+	with open(manifest_file) as f:
+		return json.load(f)
+
+
+def write_manifest(manifest_file, manifest):
+	if not exists(dirname(manifest_file)):
+		makedirs(dirname(manifest_file))
+	with open(manifest_file, 'w') as f:
+		json.dump(manifest, f, indent=1)
+
+
+# Parsed exports in folder -- returns (export -> dataframe (None for skipped exports) in folder listing order, export -> PINs that didn't parse)
+#   - refresh, parse every export again (ignoring cache)
+def load_exports(exports_folder, workers=batch_common.MAX_WORKERS, refresh=False):
+	manifest_file = get_manifest_file(exports_folder)
+	manifest = read_manifest(manifest_file)
 	exports = [ f for f in listdir(exports_folder) if f.endswith('.csv') ]
+
+	entries, frames, to_parse = {}, {}, []
 	for export in exports:
-		df = pd.read_csv(join(exports_folder, export)).dropna(how='all')
-		if UNADJUSTED not in df.columns:
-			print('WARNING: SKIPPING "{}", Column named "{}" not found'.format(export,UNADJUSTED))
+		stat = os.stat(join(exports_folder, export))
+		entry = manifest.get(export)
+		if not entry or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+			content_hash = redcap_cache.hash_file(join(exports_folder, export))
+			entry = entry if entry and entry['hash'] == content_hash else { 'hash': content_hash }
+			entry.update(size=stat.st_size, mtime=stat.st_mtime)
+		entries[export] = entry
+
+		if refresh or 'status' not in entry:
+			to_parse.append(export)
 			continue
-		else:
-			print('Processing: "{}"'.format(export))
-
-		# df.to_csv('df_before_rename.csv')
-		df = df.rename(columns={'PIN': 'newt_id',  'RawScore': 'raw', 'TScore': 'tscore'})
-
-		# check for S2 mismatch
-		if ( 'S2' in export.upper()):
-			S2_mismatch = True in ( 'S2' not in newt_id.upper() for newt_id in df['newt_id'].drop_duplicates().tolist() )
-			if S2_mismatch:
-				print('WARNING: S2 mismatch detected in "{}", check csv file'.format(export))
-
-		# df.to_csv('df_after_rename.csv')
-		parent_df = df[df['newt_id'].str.contains('parent', flags=re.IGNORECASE)]
-		# parent_df.to_csv('parent_df.csv')
-		subject_df = df[~df['newt_id'].isin(parent_df['newt_id'])]
-
-		if not parent_df.empty:
-			parent_df = replace_variables(parent_df, parent_vars)
-			parent_df = extract_id_and_session(parent_df)
-			# print(export, " contains parent data")
-		else:
-			parent_df = None
-
-		if not subject_df.empty:
-			subject_df = subject_df.groupby('newt_id').apply(lambda x: replace_variables(x, subject_vars) if len(x) > 4 else replace_variables(x, parent_vars))
-			# subject_df.to_csv('subject_df_before_extract.csv')
-			subject_df = extract_id_and_session(subject_df)
-		else:
-			subject_df = None
-
-		export_df = pd.concat([subject_df, parent_df], axis=0)
-		result = pd.concat([result, export_df], axis=0)
+		df = None
+		if entry['status'] == 'ok':
+			df, _ = redcap_cache.read_cache(get_export_key(entry['hash']))
+			if df is None: # cache entry was removed
+				to_parse.append(export)
+				continue
+		frames[export] = df
+		print('Unchanged: "{}"'.format(export))
+		for message in entry['messages']:
+			print(message)
+
+	if to_parse:
+		with ProcessPoolExecutor(max_workers=workers) as executor:
+			futures = { executor.submit(process_export, join(exports_folder, export)): export for export in to_parse }
+			for future in as_completed(futures):
+				export = futures[future]
+				df, messages, invalid_pins = future.result()
+				print('Processed: "{}"'.format(export))
+				for message in messages:
+					print(message)
+
+				frames[export] = df
+				entries[export].update(status='ok' if df is not None else 'skipped', messages=messages, invalid_pins=invalid_pins)
+				if df is not None:
+					try:
+						redcap_cache.write_cache(get_export_key(entries[export]['hash']), df, { 'export': export })
+					except (ValueError, TypeError): # columns parquet can't store (i.e. mixed types) -- parsed again next time
+						del entries[export]['status']
+
+	write_manifest(manifest_file, entries)
+	invalid_pins = { export: entries[export]['invalid_pins'] for export in exports if entries[export].get('invalid_pins') }
+	return { export: frames[export] for export in exports }, invalid_pins
+
+
+# PINs that didn't parse (export, PIN), written next to results so they can be fixed in the exports
+def write_pin_report(invalid_pins, report_file='nih_invalid_pins.csv'):
+	report = pd.DataFrame([ (export, pin) for export, pins in invalid_pins.items() for pin in pins ], columns=['export', 'PIN'])
+	report.to_csv(report_file, index=False)
+	print('WARNING: {} PIN(s) could not be parsed (listed in {})'.format(len(report), report_file))
+
+
+def nih_toolbox_import(exports_folder, subjects, workers=batch_common.MAX_WORKERS, refresh=False):
+	frames, invalid_pins = load_exports(exports_folder, workers, refresh)
+	if invalid_pins:
+		write_pin_report(invalid_pins)
+
+	frames = [ df for df in frames.values() if df is not None ]
+	if not frames:
+		print('No exports to process.')
+		return
+	result = pd.concat(frames, axis=0)
 
 	print('Formatting...')
 
@@ -132,6 +284,8 @@ def parse_args():
 	required_group.add_argument('--exports_folder', widget='DirChooser', required=True, help='Folder containing export files to be processed')
 	optional_group = parser.add_argument_group('Optional Arguments', gooey_options={'columns': 1})
 	optional_group.add_argument('-s', '--subjects', nargs='+', help='Space separated list of subject ids to run for (if blank, runs all in folder)')
+	optional_group.add_argument('--workers', type=int, default=batch_common.MAX_WORKERS, help='Number of exports to parse at once')
+	optional_group.add_argument('--refresh', action='store_true', help='Parse every export again (by default, exports that haven\'t changed since the last run are read from cache)')
 	return parser.parse_args()
 
 
@@ -140,4 +294,4 @@ if __name__ == '__main__':
 	if not exists(args.exports_folder):
 		parse_args.error('Specified folder does not exist.')
 
-	nih_toolbox_import(args.exports_folder, args.subjects)
+	nih_toolbox_import(args.exports_folder, args.subjects, args.workers, args.refresh)
@@ -4,7 +4,7 @@ import pandas as pd
 import redcap_common
 import shutil
 
-from gooey import Gooey, GooeyParser
+from gooey_common import Gooey, GooeyParser
 from wfs_db_migration import replace_values
 
 STATIC_FOLDER = r'//neuroimage.wustl.edu/nil/hershey/H/REDCap Scripts/static/'
@@ -1,13 +1,16 @@
+import pandas as pd
 import re
+import redcap_cache
 import redcap_common
 
-from gooey import Gooey, GooeyParser
+from gooey_common import Gooey, GooeyParser
 
 @Gooey
 def parse_args():
     parser = GooeyParser(description='Converts data in REDCap format (one row per session) to SPSS format (one row per subject) and vice versa')
     parser.add_argument('input_file', widget='FileChooser', help='csv file (full path) to be formatted (first column should contain subject ids)')
     parser.add_argument('output_file', help='csv file (full path) to store formatted data (if file does not exist, it will be created)')
+    parser.add_argument('--data_dictionary', widget='FileChooser', help='REDCap data dictionary csv (loads REDCap export with compact column types)')
 
     args = parser.parse_args()
     if not args.input_file.endswith('.csv') or not args.output_file.endswith('.csv'):
@@ -16,24 +19,24 @@ def parse_args():
     return args
 
 
-def redcap2spss(input_file, output_file):
-    df = redcap_common.create_df(input_file)
+def redcap2spss(input_file, output_file, data_dictionary=None):
+    subject_ids = pd.read_csv(input_file, usecols=[0]).iloc[:, 0] # only read ids to decide direction (full file is only needed for redcap to spss)
 
-    if df.shape[0] == len(df.iloc[:, 0].unique()): # if the row count is the same as the unique indentifiers, assume spss to redcap
+    if len(subject_ids) == len(subject_ids.unique()): # if the row count is the same as the unique indentifiers, assume spss to redcap
         # get columns that have session as a suffix and make it a prefix instead (this is the format expand expects)
-        suffixed_cols = { col: '_'.join([col[-2:], col[:-3]]) for col in df.columns if re.search(r'_s\d$', col) }
-        if suffixed_cols:
-            df = df.rename(columns=suffixed_cols)
+        columns = pd.read_csv(input_file, nrows=0).columns
+        suffixed_cols = { col: '_'.join([col[-2:], col[:-3]]) for col in columns if re.search(r'_s\d$', col) }
 
-        df, non_session_cols = redcap_common.expand(df.set_index(df.columns[0]))
-        df= df.set_index(df.columns[0])
+        # expand in chunks so very wide files don't have to be held in memory
+        redcap_common.write_and_open(lambda f: redcap_common.expand_csv(input_file, f, suffixed_cols), output_file)
     else: # assume redcap to spss
+        schema = redcap_cache.read_data_dictionary(data_dictionary) if data_dictionary else None
+        df = redcap_common.create_df(input_file, schema, report=schema is not None)
         prefix = 's' if df[df.columns[1]].dtype == 'int64' else ''
         df = redcap_common.flatten(df.set_index([df.columns[0], df.columns[1]]), sort=True, prefix=prefix)
-
-    redcap_common.write_results_and_open(df, output_file)
+        redcap_common.write_results_and_open(df, output_file)
 
 
 if __name__ == '__main__':
     args = parse_args()
-    redcap2spss(args.input_file, args.output_file)
+    redcap2spss(args.input_file, args.output_file, args.data_dictionary)
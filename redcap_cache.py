@@ -0,0 +1,269 @@
+import hashlib
+import inspect
+import json
+import os
+import pandas as pd
+
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+from glob import glob
+
+# Local cache of REDCap API exports (one parquet file + json info file per project/field set)
+CACHE_DIR = os.environ.get('REDCAP_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.redcap_cache'))
+CACHE_SIZE_LIMIT = 500 * 1024**2 # bytes, least recently used entries are removed once cache grows past this
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S' # format REDCap uses for dateRangeBegin/dateRangeEnd
+PULL_OVERLAP = timedelta(minutes=5) # changes since this long before the last pull are requested again (re-pulled records just replace their cached rows)
+
+
+def get_project_key(project):
+    return hashlib.sha1('|'.join([project.url, project.token]).encode()).hexdigest()[:16]
+
+
+def get_cache_key(project, fields):
+    fields_key = '|'.join(sorted(fields)) if fields else '*'
+    return '_'.join([get_project_key(project), hashlib.sha1(fields_key.encode()).hexdigest()[:16]])
+
+
+def get_cache_paths(key, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, key + '.parquet'), os.path.join(cache_dir, key + '.json')
+
+
+# Cached dataframe and info for key, or (None, None) if there is no usable entry
+#   - entry that can't be read (i.e. removed by another process while reading) is treated as a cache miss
+#   - last use is recorded as the data file's modification time, so reading never rewrites a file other processes may be reading
+def read_cache(key, cache_dir=CACHE_DIR):
+    data_file, info_file = get_cache_paths(key, cache_dir)
+    try:
+        with open(info_file) as f:
+            info = json.load(f)
+        df = pd.read_parquet(data_file)
+    except (OSError, ValueError):
+        return None, None
+
+    try:
+        os.utime(data_file)
+    except OSError:
+        pass
+    return df, info
+
+
+def write_cache(key, df, info, cache_dir=CACHE_DIR, size_limit=CACHE_SIZE_LIMIT):
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # written to temporary files first, so other processes using the cache never read a partly written entry
+    data_file, info_file = get_cache_paths(key, cache_dir)
+    tmp_suffix = '.{}.tmp'.format(os.getpid())
+    df.to_parquet(data_file + tmp_suffix)
+    with open(info_file + tmp_suffix, 'w') as f:
+        json.dump(info, f)
+    os.replace(data_file + tmp_suffix, data_file)
+    os.replace(info_file + tmp_suffix, info_file)
+
+    enforce_size_limit(cache_dir, size_limit, keep=[key])
+
+
+# Removes least recently used (by data file modification time) entries until cache is under size_limit (entries in keep are never removed)
+def enforce_size_limit(cache_dir=CACHE_DIR, size_limit=CACHE_SIZE_LIMIT, keep=()):
+    entries = []
+    for data_file in glob(os.path.join(cache_dir, '*.parquet')):
+        key = os.path.splitext(os.path.basename(data_file))[0]
+        try:
+            last_used = os.path.getmtime(data_file)
+            size = sum(os.path.getsize(path) for path in get_cache_paths(key, cache_dir) if os.path.exists(path))
+        except OSError: # removed by another process
+            continue
+        entries.append((last_used, key, size))
+
+    total_size = sum(size for _, _, size in entries)
+    for _, key, size in sorted(entries):
+        if total_size <= size_limit:
+            break
+        if key in keep:
+            continue
+        remove_cache_entry(key, cache_dir)
+        total_size -= size
+
+
+def remove_cache_entry(key, cache_dir=CACHE_DIR):
+    for path in get_cache_paths(key, cache_dir):
+        try:
+            os.remove(path)
+        except FileNotFoundError: # already removed (i.e. by another process)
+            pass
+
+
+# Explicit invalidation
+#   - project and fields, remove that export
+#   - project only, remove all exports (and schema snapshot) for project
+#   - neither, clear whole cache
+def invalidate_cache(project=None, fields=None, cache_dir=CACHE_DIR):
+    if project is not None and fields is not None:
+        remove_cache_entry(get_cache_key(project, fields), cache_dir)
+        return
+
+    pattern = get_project_key(project) + '_*.json' if project is not None else '*.json'
+    for info_file in glob(os.path.join(cache_dir, pattern)):
+        remove_cache_entry(os.path.splitext(os.path.basename(info_file))[0], cache_dir)
+
+
+# Replace cached rows for any record included in changed_df (REDCap returns all of a record's rows when anything in it changed)
+def merge_changed_records(cached_df, changed_df):
+    changed_ids = changed_df.index.get_level_values(0).unique()
+    df = pd.concat([cached_df[~cached_df.index.get_level_values(0).isin(changed_ids)], changed_df])
+
+    # columns that were read as different types in cache and changes are stored as text (how a full export would read them)
+    mixed_cols = [ col for col in changed_df.columns if col in cached_df.columns and cached_df[col].dtype != changed_df[col].dtype and df[col].dtype == object ]
+    for col in mixed_cols:
+        df[col] = df[col].where(df[col].isnull(), df[col].astype(str))
+    return df
+
+
+# Drop cached rows of records that are no longer in the project (deleted records don't show up in date range exports)
+def drop_deleted_records(cached_df, record_ids):
+    return cached_df[cached_df.index.get_level_values(0).astype(str).isin(pd.Index(record_ids).astype(str))]
+
+
+# Record ids currently in the project (only the record id field is exported)
+def get_record_ids(project, export_records):
+    id_field = get_schema(project)['metadata'][0]['field_name']
+    ids_df = export_records(project, [id_field])
+    return ids_df.index.get_level_values(0).unique() if len(ids_df.index) else pd.Index([]) # export has no columns (ids are the index), so can't check .empty
+
+
+# Current time on the REDCap server (from the Date header of a version request, in local time), so date ranges don't depend on this computer's clock
+#   (falls back to local time if server doesn't send one)
+def get_server_time(project):
+    import requests
+
+    response = requests.post(project.url, data={ 'token': project.token, 'content': 'version' })
+    date = response.headers.get('Date')
+    return parsedate_to_datetime(date).astimezone().replace(tzinfo=None) if date else datetime.now()
+
+
+# PyCap 2 renamed export_records' format argument to format_type
+def pycap_export_records(project, fields=None, date_begin=None):
+    format_arg = 'format_type' if 'format_type' in inspect.signature(project.export_records).parameters else 'format'
+    return project.export_records(fields=fields, date_begin=date_begin, **{ format_arg: 'df' })
+
+
+# Export records from REDCap, using local cache where possible
+#   - only records changed since last pull are requested (uses API date range filtering, pull times are taken from the server's clock)
+#   - prune_deleted, export all record ids too, so records deleted from REDCap since last pull are dropped from cache
+#     (deleted records don't show up in date range exports, so they are kept otherwise)
+#   - refresh=False returns cached data without contacting REDCap at all (if it exists)
+#   - export_records, function(project, fields, date_begin) used to pull from API (i.e. redcap_export.export_records)
+def export_records_cached(project, fields=None, refresh=True, prune_deleted=False, cache_dir=CACHE_DIR, size_limit=CACHE_SIZE_LIMIT, export_records=pycap_export_records):
+    key = get_cache_key(project, fields)
+    cached_df, info = read_cache(key, cache_dir)
+    if cached_df is not None and not refresh:
+        return cached_df
+
+    pull_time = get_server_time(project) # taken before request so changes made while it is running are picked up next time
+    if cached_df is None:
+        df = export_records(project, fields)
+    else:
+        changed_df = export_records(project, fields, date_begin=datetime.strptime(info['last_pull'], DATE_FORMAT) - PULL_OVERLAP)
+        df = merge_changed_records(cached_df, changed_df) if not changed_df.empty else cached_df
+        if prune_deleted:
+            df = drop_deleted_records(df, get_record_ids(project, export_records))
+
+    write_cache(key, df, { 'fields': fields, 'last_pull': pull_time.strftime(DATE_FORMAT) }, cache_dir, size_limit)
+    return df
+
+
+## Schema snapshot (data dictionary stored locally, versioned by hash of the metadata)
+
+# data dictionary csv columns, in the same order as the API's metadata keys
+METADATA_KEYS = ['field_name', 'form_name', 'section_header', 'field_type', 'field_label', 'select_choices_or_calculations', 'field_note',
+    'text_validation_type_or_show_slider_number', 'text_validation_min', 'text_validation_max', 'identifier', 'branching_logic',
+    'required_field', 'custom_alignment', 'question_number', 'matrix_group_name', 'matrix_ranking', 'field_annotation']
+
+
+def get_checkbox_codes(choices):
+    options = [ choice.split(',', 1)[0].strip() for choice in choices.split('|') ]
+    return [ opt.lower().replace('-', '_') for opt in options if opt ] # export replaces '-' in codes with '_'
+
+
+# Builds indexed lookups from metadata (list of field dicts, as returned by API)
+#   - form_fields, form -> fields
+#   - field_types, field -> type
+#   - field_forms, field -> form
+#   - checkbox_columns, checkbox field -> expanded field___N columns
+def build_schema(metadata):
+    version = hashlib.sha1(json.dumps(metadata, sort_keys=True).encode()).hexdigest()[:16]
+    schema = { 'version': version, 'metadata': metadata, 'form_fields': {}, 'field_types': {}, 'field_forms': {}, 'checkbox_columns': {} }
+    for field in metadata:
+        name = field['field_name']
+        schema['form_fields'].setdefault(field['form_name'], []).append(name)
+        schema['field_types'][name] = field['field_type']
+        schema['field_forms'][name] = field['form_name']
+        if field['field_type'] == 'checkbox':
+            schema['checkbox_columns'][name] = [ '___'.join([name, code]) for code in get_checkbox_codes(field['select_choices_or_calculations']) ]
+    return schema
+
+
+# Builds schema from a data dictionary csv (downloaded from REDCap) instead of the API
+def read_data_dictionary(dictionary_file):
+    dd_df = pd.read_csv(dictionary_file, dtype=str).fillna('')
+    dd_df.columns = METADATA_KEYS[:len(dd_df.columns)]
+    return build_schema(dd_df.to_dict('records'))
+
+
+# Columns a set of fields has in a record export (checkbox fields export one column per option)
+def get_export_columns(schema, fields):
+    return [ col for field in fields for col in schema['checkbox_columns'].get(field, [field]) ]
+
+
+def get_form_columns(schema, form):
+    return get_export_columns(schema, schema['form_fields'].get(form, []))
+
+
+def get_fields_of_type(schema, field_type):
+    return [ field for field, ftype in schema['field_types'].items() if ftype == field_type ]
+
+
+def read_schema_snapshot(schema_file):
+    try:
+        with open(schema_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+# Get local schema snapshot for project (metadata is only requested from API if there is no snapshot or refresh is set)
+#   - on refresh, if data dictionary changed since snapshot was taken (version differs), cached record exports for project are removed too
+#     (they were pulled with the old fields)
+def get_schema(project, refresh=False, cache_dir=CACHE_DIR):
+    schema_file = os.path.join(cache_dir, get_project_key(project) + '_schema.json')
+    snapshot = read_schema_snapshot(schema_file)
+    if snapshot is not None and not refresh:
+        return build_schema(snapshot['metadata'])
+
+    schema = build_schema(project.export_metadata())
+    if snapshot is not None and snapshot.get('version') != schema['version']:
+        print('### Data dictionary changed since {}, removing cached exports for project ###'.format(snapshot.get('pulled')))
+        invalidate_cache(project, cache_dir=cache_dir)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = schema_file + '.{}.tmp'.format(os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump({ 'version': schema['version'], 'metadata': schema['metadata'], 'pulled': datetime.now().strftime(DATE_FORMAT) }, f)
+    os.replace(tmp_file, schema_file)
+    return schema
+
+
+## Intermediate results (content addressed -- key is a hash of the input file contents and the options used to produce them)
+
+def hash_file(path, chunk_size=1024**2):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+# Key for read_cache/write_cache from anything json-serializable (file hashes, option values, ...)
+def get_content_key(*parts):
+    return 'stage_' + hashlib.sha1(json.dumps(parts).encode()).hexdigest()[:32]
@@ -1,17 +1,20 @@
 import numpy as np
+import os
 import pandas as pd
+from pandas.api.extensions import take
 from pandas.api.types import is_numeric_dtype
 import re
+import redcap_cache
 
+from bisect import bisect
 from getpass import getpass
 from itertools import groupby, chain
-from redcap import Project
 from subprocess import Popen
 from sys import exit, stderr
 
 # API constants
 DB_PATH = r'//neuroimage.wustl.edu/nil/hershey/H/REDCap Scripts/api_tokens.accdb'
-URL = 'https://redcap.wustl.edu/redcap/srvrs/prod_v3_1_0_001/redcap/api/'
+URL = os.environ.get('REDCAP_API_URL', 'https://redcap.wustl.edu/redcap/srvrs/prod_v3_1_0_001/redcap/api/')
 
 STUDY_ID = 'study_id'
 SESSION_YEAR = 'session_year'
@@ -22,8 +25,108 @@ SESSION_AGE = 'session_age'
 
 COMMON_COLS = [STUDY_ID, SESSION_YEAR, DOB, SESSION_DATE, SESSION_NUMBER]
 
-def create_df(input_file):
-    return pd.read_csv(input_file)
+# REDCap columns (other than record id) that only take a handful of values
+ID_COLUMNS = ['redcap_event_name', 'redcap_repeat_instrument', 'redcap_data_access_group']
+CODED_FIELD_TYPES = ['radio', 'dropdown', 'yesno', 'truefalse']
+
+
+# Smallest nullable int type that fits all of a coded field's options (None if options are not all integers)
+def get_code_dtype(codes):
+    try:
+        codes = [ int(code) for code in codes ]
+    except ValueError:
+        return None
+    for dtype in ['Int8', 'Int16', 'Int32']:
+        info = np.iinfo(dtype.lower())
+        if all(info.min <= code <= info.max for code in codes):
+            return dtype
+    return 'Int64'
+
+
+# Compact dtypes for export columns based on data dictionary (schema from redcap_cache)
+#   - record id and event columns are categories
+#   - radio/dropdown/yesno/truefalse fields and form status columns are nullable small ints, checkbox columns are Int8
+#   - date validated text fields are parsed as dates (returned separately as list of columns)
+#   - strings, leave everything other than ids as text
+def get_compact_dtypes(schema, columns, strings=False):
+    id_field = schema['metadata'][0]['field_name']
+    checkbox_columns = set(chain.from_iterable(schema['checkbox_columns'].values()))
+    fields = { field['field_name']: field for field in schema['metadata'] }
+
+    dtypes, date_cols = {}, []
+    for col in columns:
+        field = fields.get(col, {})
+        if col == id_field or col in ID_COLUMNS:
+            dtypes[col] = 'category'
+        elif strings:
+            dtypes[col] = object
+        elif col in checkbox_columns or (col.endswith('_complete') and col[:-len('_complete')] in schema['form_fields']):
+            dtypes[col] = 'Int8'
+        elif field.get('field_type') in ['yesno', 'truefalse']:
+            dtypes[col] = 'Int8'
+        elif field.get('field_type') in CODED_FIELD_TYPES:
+            dtype = get_code_dtype(redcap_cache.get_checkbox_codes(field['select_choices_or_calculations']))
+            if dtype:
+                dtypes[col] = dtype
+        elif field.get('field_type') == 'text' and field.get('text_validation_type_or_show_slider_number', '').startswith(('date_', 'datetime_')):
+            date_cols.append(col)
+    return dtypes, date_cols
+
+
+# Supported file formats for results (csv can be compressed, parquet/feather keep column types so chained scripts don't re-parse text)
+FILE_FORMATS = ['csv', 'csv.gz', 'csv.zst', 'parquet', 'feather']
+COLUMNAR_FORMATS = ['parquet', 'feather']
+
+
+# File format from extension (anything unrecognized is treated as csv)
+def get_file_format(filename):
+    return next((fmt for fmt in FILE_FORMATS[1:] if filename.lower().endswith('.' + fmt)), 'csv')
+
+
+# Filename without format extension (i.e. 'data.csv.gz' -> 'data')
+def strip_file_format(filename):
+    fmt = get_file_format(filename)
+    return filename[:-len(fmt) - 1] if filename.lower().endswith('.' + fmt) else os.path.splitext(filename)[0]
+
+
+# Columnar files are written with their index as regular columns (see write_df), so they read back the same way a csv does
+def read_columnar(input_file, fmt):
+    df = pd.read_parquet(input_file) if fmt == 'parquet' else pd.read_feather(input_file)
+    return df.reset_index() if not isinstance(df.index, pd.RangeIndex) else df
+
+
+REPORT_SAMPLE_ROWS = 10000 # rows create_df's memory report estimates default types size from
+
+
+# Load REDCap csv export (or results written by write_df -- parquet/feather are already typed, so schema and strings only apply to csv)
+#   - schema (see redcap_cache.read_data_dictionary/get_schema), assign compact dtypes at parse time based on data dictionary
+#   - strings, read everything (other than ids) as text
+#   - report, print how much memory compact dtypes saved (compared to default types, estimated from a sample of rows)
+def create_df(input_file, schema=None, strings=False, report=False):
+    fmt = get_file_format(input_file)
+    if fmt in COLUMNAR_FORMATS:
+        return read_columnar(input_file, fmt)
+
+    if schema is None:
+        return pd.read_csv(input_file, dtype=object if strings else None)
+
+    dtypes, date_cols = get_compact_dtypes(schema, pd.read_csv(input_file, nrows=0).columns, strings)
+    try:
+        df = pd.read_csv(input_file, dtype=dtypes, parse_dates=date_cols)
+    except (ValueError, TypeError): # some values don't fit data dictionary (i.e. labels exported instead of raw codes) -- convert columns that do after parsing
+        df = pd.read_csv(input_file, dtype={ col: dtype for col, dtype in dtypes.items() if dtype in ['category', object] }, parse_dates=date_cols)
+        for col, dtype in dtypes.items():
+            try:
+                df[col] = df[col].astype(dtype)
+            except (ValueError, TypeError):
+                pass
+
+    if report: # default types size is estimated from the first rows (reading the whole file again would use more memory than the compact load saves)
+        sample = pd.read_csv(input_file, dtype=object if strings else None, nrows=REPORT_SAMPLE_ROWS)
+        default_size = sample.memory_usage(deep=True).sum() * len(df) / max(len(sample), 1) / 1024**2
+        compact_size = df.memory_usage(deep=True).sum() / 1024**2
+        print('### Memory used = {:.1f} MB (default types = ~{:.1f} MB, saved ~{:.1f} MB) ###'.format(compact_size, default_size, default_size - compact_size))
+    return df
 
 
 # Rename common columns used in shared functions
@@ -34,19 +137,70 @@ def rename_common_columns(df, renames, reset):
     return df.rename(columns=rename_dict)
 
 
+ARM_PATTERN = r'_arm_.'
+STABLE_EVENT = 'stable'
+
+# Everything derived from an event name, built once per unique event (exports only have a handful) instead of once per row
+#   - event, name without arm suffix
+#   - session_year, year of clinic-year events (NaN for stable and mini-clinic events, which are year-agnostic)
+#   - clinic_year, label for clinic year ('0' for stable, mc<N> for mini-clinic N, year otherwise)
+#   - stable, whether event is the stable (year-agnostic) event
+def get_event_table(events):
+    events = pd.Index(events).dropna().unique()
+    table = pd.DataFrame(index=events)
+    table['event'] = events.str.replace(ARM_PATTERN, '', regex=True)
+    prefix = table['event'].str[0:4]
+    table['stable'] = table['event'] == STABLE_EVENT
+    table[SESSION_YEAR] = pd.to_numeric(prefix, errors='coerce')
+    table['clinic_year'] = np.where(prefix == 'stab', '0', np.where(prefix == 'mini', 'mc' + table['event'].str[12:13], prefix))
+    return table
+
+
+# Columns of event table (see get_event_table) for each row, looked up through categorical codes (so cost per row is just an array take)
+#   - events that are null get NaN in every column
+def map_events(events, columns=None):
+    events = events.astype('category')
+    table = get_event_table(events.cat.categories)
+    codes = events.cat.codes.to_numpy()
+    columns = columns or list(table.columns)
+    return pd.DataFrame({ col: take(table[col].to_numpy(), codes, allow_fill=True) for col in columns }, index=events.index)
+
+
+# Event names without arm suffix, as a categorical (only the unique names are normalized)
+def normalize_events(events):
+    events = events.astype('category')
+    codes, normalized = pd.factorize(get_event_table(events.cat.categories)['event'])
+    event_codes = events.cat.codes.to_numpy()
+    return pd.Series(pd.Categorical.from_codes(np.where(event_codes >= 0, codes[event_codes], -1), normalized), index=events.index, name=events.name)
+
+
 # create separate dataframe with demographic/diagnosis info from API export
-def get_redcap_project(project, api_token=None):
+#   - url can point at a local stand-in server (see tools/fake_redcap_server.py)
+#   - refresh_schema, pull data dictionary again (local snapshot is used otherwise, see redcap_cache.get_schema)
+def get_redcap_project(project, api_token=None, url=URL, refresh_schema=False):
     if not api_token:
         print('\nRequested action requires API access. Enter API token to continue.')
         api_token = getpass()
 
-    project = Project(URL, api_token)
+    from redcap import Project # PyCap (and requests) are only loaded when API access is needed
+
+    project = Project(url, api_token)
+    if refresh_schema:
+        redcap_cache.get_schema(project, refresh=True)
     return project
 
 
-def merge_api_data(df, project, fields, left_merge_fields):
+# use_cache, only pull records changed since the last run (see redcap_cache)
+#   prune_deleted, also drop cached records that were deleted from REDCap (exports every record id)
+#   records are pulled in concurrent batches (see redcap_export)
+def merge_api_data(df, project, fields, left_merge_fields, use_cache=True, prune_deleted=False):
+    import redcap_export
+
     project = project if project else get_redcap_project()
-    demo_dx_df = project.export_records(fields=fields, format='df')
+    if use_cache:
+        demo_dx_df = redcap_cache.export_records_cached(project, fields, prune_deleted=prune_deleted, export_records=redcap_export.export_records)
+    else:
+        demo_dx_df = redcap_export.export_records(project, fields)
     df = df.merge(demo_dx_df, how='left', left_on=left_merge_fields, right_index=True, suffixes=('_original', ''))
     return df
 
@@ -69,13 +223,28 @@ def get_age(date1, date2):
     return (date2 - date1).days / float(365.25)
 
 
+# Column-wise version of get_age (dob_col should be dob) -- NaT in either column gives NaN, same as get_age
+def get_age_column(dob_col, date_col):
+    return (date_col - dob_col).dt.days / float(365.25)
+
+
+# fills in column for missing rows using first-found (non-null) value for each participant
+def fill_first_valid(df, column, group_column=STUDY_ID):
+    return df.groupby(group_column)[column].transform('first')
+
+
+# Inserts fractional age at date_column (as age_column) right before date_column in df
+#   - reusable for any date-to-age derivation (session age, mri age, etc.)
+def calculate_age(df, date_column, age_column, dob_column=DOB):
+    df[date_column] = pd.to_datetime(df[date_column], errors='coerce')
+    df[dob_column] = pd.to_datetime(fill_first_valid(df, dob_column)) # fills in dob for missing years using first-found dob for participant
+    df.insert(df.columns.get_loc(date_column), age_column, get_age_column(df[dob_column], df[date_column]))
+    return df
+
+
 def prepare_age_calc(df):
     # put new session_age right after session_date in df
-    df[SESSION_DATE] = pd.to_datetime(df[SESSION_DATE], errors='coerce')
-    df[DOB] = pd.to_datetime(df.groupby([STUDY_ID])[DOB].transform(lambda x: x.loc[x.first_valid_index()] if x.first_valid_index() is not None else np.nan)) # fills in dob for missing years using first-found dob for participant
-    session_age_column = df.apply(lambda x: get_age(x[DOB], x[SESSION_DATE]), axis=1)
-    df.insert(df.columns.get_loc(SESSION_DATE), SESSION_AGE, session_age_column)
-    return df
+    return calculate_age(df, SESSION_DATE, SESSION_AGE)
 
 
 # Determine age at diagnosis
@@ -109,6 +278,24 @@ def calculate_diagnosis_duration(group, dx_type, dx_age_df, age_field):
     return group
 
 
+# Diagnosis age for each participant (taken from their first session), for several diagnosis types at once
+#   - dx_types, dx_type -> dx_vars (i.e. { 'db': { 'dx_date': 'db_dx_date', 'dx_age': 'db_onset_age' } })
+#   - returns dataframe indexed by participant with a dx_<dx_type>_age column per type
+def get_diagnosis_ages(df, dx_types, session_column=SESSION_NUMBER, first_session='s1'):
+    first_sessions = df.loc[df[session_column] == first_session].drop_duplicates(STUDY_ID)
+    dx_ages = { '_'.join(['dx', dx_type, 'age']): first_sessions[dx_vars['dx_age']].astype(float).values for dx_type, dx_vars in dx_types.items() }
+    return pd.DataFrame(dx_ages, index=first_sessions[STUDY_ID].values)
+
+
+# Vectorized calculate_diagnosis_duration -- diagnosis ages for whole cohort are attached with one join on participant
+#   - adds dx_<dx_type>_duration column (session age minus diagnosis age) for each type in dx_types (see get_diagnosis_ages)
+def add_diagnosis_durations(df, dx_types, age_field=SESSION_AGE, session_column=SESSION_NUMBER, first_session='s1'):
+    dx_ages = df[[STUDY_ID]].join(get_diagnosis_ages(df, dx_types, session_column, first_session), on=STUDY_ID)
+    for dx_type in dx_types:
+        df['_'.join(['dx', dx_type, 'duration'])] = df[age_field] - dx_ages['_'.join(['dx', dx_type, 'age'])]
+    return df
+
+
 # Filter down to consecutive year data (at least n years) for participants
 
 #  default params (added to make generalizable to other scripts (finding "best" range across variables, optic nerve special condition, etc.)):
@@ -150,13 +337,51 @@ def get_consecutive_years(group, n, skip=1, keep_all=False, return_rows=False):
     return group.iloc[rows,:] if not return_rows else rows
 
 
+# Vectorized version of get_consecutive_years -- runs over all participants at once and returns a boolean row mask
+#   (rows are ordered by participant and year, so the year-agnostic event(s) with no year come first)
+#  same params as get_consecutive_years:
+#   - skip, number between years to look for
+#   - keep_all, keep all rows that are consecutive (instead of just the first n)
+#   - return_rows, return row numbers (positions in df) instead of the mask
+def get_consecutive_years_mask(df, n, skip=1, keep_all=False, return_rows=False, group_column=STUDY_ID, year_column=SESSION_YEAR):
+    years = pd.to_numeric(df[year_column], errors='coerce').values.astype(float)
+    ids = pd.factorize(df[group_column])[0] + 1 # rows without an id get 0 (never eligible, same as groupby dropping them)
+    order = np.lexsort((np.where(np.isnan(years), -np.inf, years), ids)) # sort by id, then year (nulls first)
+    ids, years = ids[order], years[order]
+    dated = ~np.isnan(years)
+
+    # participant must have at least n sessions with a year to be considered at all
+    eligible = (np.bincount(ids, weights=dated, minlength=1) >= n)[ids] & (ids > 0)
+
+    # run-length encode consecutive years: a row continues a run if previous row is the same participant and exactly skip years earlier
+    prev_year = np.concatenate(([np.nan], years[:-1]))
+    prev_id = np.concatenate(([-1], ids[:-1]))
+    continues = dated & (prev_id == ids) & (years - prev_year == skip)
+    run_ids = np.cumsum(~continues)
+    run_lengths = np.bincount(run_ids)
+    in_run = dated & (run_lengths[run_ids] >= max(n, 2))
+
+    selected = eligible & (in_run | ~dated) # year-agnostic rows are kept for participants that are eligible
+    if not keep_all:
+        counts = np.cumsum(selected)
+        group_start = np.concatenate(([True], ids[1:] != ids[:-1]))
+        offsets = np.maximum.accumulate(np.where(group_start, counts - selected, 0))
+        selected &= (counts - offsets) <= n # only keep first n rows for each participant
+
+    mask = np.zeros(len(df), dtype=bool)
+    mask[order] = selected
+    return np.flatnonzero(mask) if return_rows else pd.Series(mask, index=df.index)
+
+
 def get_matching_columns(columns, pattern):
     return [ col for col in columns if re.match(pattern, col) ]
 
 
 def get_variable_column_lists(columns, variables, project):
+    schema = redcap_cache.get_schema(project)
+
     # make sure that all the required variables actually appear in dataset (otherwise all will be filtered out)
-    missing_args = [ var for var in variables if not get_matching_columns(columns, var) ]
+    missing_args = [ var for var in variables if not get_matching_columns(columns, var) and not set(redcap_cache.get_form_columns(schema, var)) & set(columns) ]
     if missing_args:
         stderr.write('Specified variable(s) not included in data export: {}'.format(missing_args))
         exit(1)
@@ -167,8 +392,8 @@ def get_variable_column_lists(columns, variables, project):
             exact_match_columns.append(var)
             continue
 
-        if var in project.forms:
-            other_columns.append([ field['field_name'] for field in project.export_metadata(forms=[var]) ])
+        if var in schema['form_fields']:
+            other_columns.append(redcap_cache.get_form_columns(schema, var)) # form fields resolved from local schema snapshot (incl. checkbox columns)
         else:
             other_columns.append(get_matching_columns(columns, var))
 
@@ -177,73 +402,343 @@ def get_variable_column_lists(columns, variables, project):
     return exact_match_columns, other_columns
 
 
+## Checkbox columns (checkbox fields export one column per option, field___N)
+
+CHECKBOX_SEPARATOR = '___'
+
+
+# Fields a column is found under -- the column itself and everything before each '___' in it (same as col == field or col.startswith(field + '___'))
+def get_column_fields(column):
+    return [column] + [ column[:m.start()] for m in re.finditer('(?={})'.format(CHECKBOX_SEPARATOR), column) ]
+
+
+# Index of columns by field, so a field's columns (itself and/or its field___N option columns) are looked up instead of scanning every column
+#   - built once from a frame's columns, then kept up to date with rename/drop/add as the frame's columns change
+#   - lookups return columns in column order
+class ColumnIndex:
+    def __init__(self, columns):
+        self.positions = {}
+        self.fields = {}
+        self.next_position = 0
+        for col in columns:
+            self.add(col)
+
+    def __contains__(self, column):
+        return column in self.positions
+
+    def __len__(self):
+        return len(self.positions)
+
+    @property
+    def columns(self):
+        return list(self.positions)
+
+    # Adds column (after the existing ones, like assigning a new column)
+    def add(self, column, position=None):
+        if column in self.positions:
+            return
+        self.positions[column] = position if position is not None else self.next_position
+        self.next_position = max(self.next_position, self.positions[column] + 1)
+        for field in get_column_fields(column):
+            cols = self.fields.setdefault(field, [])
+            cols.insert(bisect([ self.positions[col] for col in cols ], self.positions[column]), column)
+
+    def drop(self, columns):
+        for column in columns:
+            if column not in self.positions:
+                continue
+            for field in get_column_fields(column):
+                self.fields[field].remove(column)
+                if not self.fields[field]:
+                    del self.fields[field]
+            del self.positions[column]
+
+    # Renames columns in place (renamed columns keep their position)
+    def rename(self, renames):
+        renames = { old: new for old, new in renames.items() if old in self.positions and old != new }
+        positions = [ self.positions[old] for old in renames ]
+        self.drop(renames.keys())
+        for new, position in zip(renames.values(), positions):
+            self.add(new, position)
+        self.positions = dict(sorted(self.positions.items(), key=lambda item: item[1]))
+
+    # Columns of field -- the field's own column and its checkbox option columns
+    def get(self, field):
+        return list(self.fields.get(field, []))
+
+    # Checkbox option columns of field (field___N)
+    def get_options(self, field):
+        return [ col for col in self.fields.get(field, []) if col != field ]
+
+    # Columns of each field in fields (in fields order)
+    def expand(self, fields):
+        return [ col for field in fields for col in self.fields.get(field, []) ]
+
+
+# Bit-packed checkbox families -- a family's option columns as one unsigned int column (bit i set when the i-th option is checked)
+#   - families, field -> option columns in bit order (see get_checkbox_families)
+#   - packed value is <NA> when all of the family's columns are null (a null option next to non-null ones counts as unchecked)
+#   - pack_checkboxes only packs families it can unpack exactly (0/1 values, options all null or all non-null in each row), others stay as columns
+#   - options for the any/all/count/contains operations are codes ('1') or option columns ('field___1'), all of the family's options by default
+CHECKBOX_DTYPES = ['UInt8', 'UInt16', 'UInt32', 'UInt64']
+POPCOUNT_TABLE = np.array([ bin(i).count('1') for i in range(256) ], dtype=np.uint8)
+
+
+# field -> option columns of each checkbox family in columns (from data dictionary if schema is given, otherwise from field___N column names)
+def get_checkbox_families(columns, schema=None):
+    if schema is not None:
+        columns = set(columns)
+        families = { field: [ col for col in cols if col in columns ] for field, cols in schema['checkbox_columns'].items() }
+        return { field: cols for field, cols in families.items() if cols }
+
+    families = {}
+    for col in columns:
+        if CHECKBOX_SEPARATOR in col:
+            families.setdefault(col.rsplit(CHECKBOX_SEPARATOR, 1)[0], []).append(col)
+    return families
+
+
+# Smallest unsigned int type with a bit for each option (None if there are more than 64 options)
+def get_checkbox_dtype(num_options):
+    return next((dtype for dtype in CHECKBOX_DTYPES if np.iinfo(dtype.lower()).bits >= num_options), None)
+
+
+# Packs option columns (any numeric or numeric text dtype, non-zero is checked) into one nullable unsigned int series
+def pack_bits(values):
+    dtype = get_checkbox_dtype(values.shape[1])
+    if dtype is None:
+        raise ValueError('Too many columns to pack ({}, max is 64)'.format(values.shape[1]))
+
+    data = values.astype(float).to_numpy()
+    missing = np.isnan(data)
+    np_dtype = np.dtype(dtype.lower())
+    weights = np.left_shift(np.ones(1, dtype=np_dtype), np.arange(data.shape[1], dtype=np_dtype))
+    packed = np.where((data != 0) & ~missing, weights, 0).sum(axis=1, dtype=np_dtype)
+    return pd.Series(pd.arrays.IntegerArray(packed, missing.all(axis=1)), index=values.index)
+
+
+# Option columns (Int8 0/1, <NA> where packed value is <NA>) from a packed series
+def unpack_bits(packed, option_columns):
+    values = packed.to_numpy(dtype=np.uint64, na_value=0)
+    missing = packed.isna().to_numpy()
+    bits = (values[:, None] >> np.arange(len(option_columns), dtype=np.uint64)) & np.uint64(1)
+    return pd.DataFrame({ col: pd.arrays.IntegerArray(bits[:, i].astype(np.int8), missing.copy()) for i, col in enumerate(option_columns) }, index=packed.index)
+
+
+# Frame with each family's option columns replaced by one packed column (named for the field, where its first option column was)
+#   - returns (frame, families that were packed) -- pass the packed families to unpack_checkboxes to get the ___N layout back
+def pack_checkboxes(df, families):
+    packed, packed_families = {}, {}
+    for field, cols in families.items():
+        try:
+            values = df[cols].astype(float)
+        except ValueError: # text that isn't a number
+            continue
+        present = values.notnull().to_numpy()
+        checked = values.to_numpy()[present]
+        if len(cols) > 64 or (present.any(axis=1) & ~present.all(axis=1)).any() or not ((checked == 0) | (checked == 1)).all():
+            continue
+        packed[cols[0]] = (field, pack_bits(values))
+        packed_families[field] = cols
+
+    packed_columns = set(chain.from_iterable(packed_families.values()))
+    columns = {}
+    for col in df.columns:
+        if col in packed:
+            field, bits = packed[col]
+            columns[field] = bits
+        elif col not in packed_columns:
+            columns[col] = df[col]
+    return pd.DataFrame(columns, index=df.index), packed_families
+
+
+# Frame with each packed column expanded back to its option columns (REDCap's field___N layout, for import)
+def unpack_checkboxes(df, families):
+    columns = {}
+    for col in df.columns:
+        if col in families:
+            columns.update(unpack_bits(df[col], families[col]).items())
+        else:
+            columns[col] = df[col]
+    return pd.DataFrame(columns, index=df.index)
 
-def check_for_all(df, all_vars, project, cast_numeric=False):
-    exact_match_columns, other_columns = get_variable_column_lists(df.columns, all_vars, project)
-    df = df.drop(df[df[exact_match_columns].apply(lambda x: pd.to_numeric(x, errors='coerce') if cast_numeric else x).isnull().any(axis=1)].index)
+
+def get_option_mask(option_columns, options=None):
+    if options is None:
+        return (1 << len(option_columns)) - 1
+    bits = { col: i for i, col in enumerate(option_columns) }
+    bits.update({ col.rsplit(CHECKBOX_SEPARATOR, 1)[-1]: i for i, col in enumerate(option_columns) })
+    return sum(1 << bits[str(option)] for option in set(options))
+
+
+def get_masked_bits(packed, option_columns, options=None):
+    mask = np.uint64(get_option_mask(option_columns, options))
+    return packed.to_numpy(dtype=np.uint64, na_value=0) & mask, mask, packed.isna().to_numpy()
+
+
+# Whether any of options is checked (<NA> where packed value is)
+def checkbox_any(packed, option_columns, options=None):
+    values, _, missing = get_masked_bits(packed, option_columns, options)
+    return pd.Series(pd.arrays.BooleanArray(values != 0, missing), index=packed.index)
+
+
+# Whether all of options are checked
+def checkbox_all(packed, option_columns, options=None):
+    values, mask, missing = get_masked_bits(packed, option_columns, options)
+    return pd.Series(pd.arrays.BooleanArray(values == mask, missing), index=packed.index)
+
+
+# Number of options checked
+def checkbox_count(packed, option_columns, options=None):
+    values, _, missing = get_masked_bits(packed, option_columns, options)
+    counts = POPCOUNT_TABLE[np.ascontiguousarray(values).view(np.uint8)].reshape(-1, 8).sum(axis=1)
+    return pd.Series(pd.arrays.IntegerArray(counts.astype(np.int8), missing), index=packed.index)
+
+
+def checkbox_contains(packed, option_columns, option):
+    return checkbox_any(packed, option_columns, [option])
+
+
+
+# Completeness index -- non-null (or numeric, if cast_numeric) status of each column, computed once per export
+def get_completeness(df, columns=None, cast_numeric=False):
+    df = df[columns] if columns is not None else df
+    if cast_numeric:
+        return df.apply(lambda x: pd.to_numeric(x, errors='coerce')).notnull()
+    return df.notnull()
+
+
+# Resolves any combination of all/any requirements to a single boolean row mask
+#   - all_vars, all specified data points required (for categories/prefixes, at least one of its columns)
+#   - any_vars, at least one specified data point required
+#   - completeness, precomputed completeness index (from get_completeness) to reuse across calls
+def get_complete_rows(df, project, all_vars=None, any_vars=None, cast_numeric=False, completeness=None):
+    all_exact, all_other = get_variable_column_lists(df.columns, all_vars, project) if all_vars else ([], [])
+    any_exact, any_other = get_variable_column_lists(df.columns, any_vars, project) if any_vars else ([], [])
+    any_columns = any_exact + list(chain.from_iterable(any_other)) # for 'any' we can search all the columns together (just one overall has to be non-null)
+
+    columns = list(dict.fromkeys(chain(all_exact, chain.from_iterable(all_other), any_columns)))
+    if completeness is None:
+        completeness = get_completeness(df, columns, cast_numeric)
+    complete = completeness[columns].to_numpy()
+    column_idx = { col: i for i, col in enumerate(columns) }
+
+    mask = complete[:, [ column_idx[col] for col in all_exact ]].all(axis=1)
     # for all, we have to make sure each var's column isn't all null
-    for col_list in other_columns:
-        df = df.drop(df[df[col_list].apply(lambda x: pd.to_numeric(x, errors='coerce') if cast_numeric else x).isnull().all(axis=1)].index)
-    return df
+    for col_list in all_other:
+        mask &= complete[:, [ column_idx[col] for col in col_list ]].any(axis=1)
+    if any_vars:
+        mask &= complete[:, [ column_idx[col] for col in any_columns ]].any(axis=1)
+    return pd.Series(mask, index=df.index)
+
+
+def check_for_all(df, all_vars, project, cast_numeric=False):
+    return df[get_complete_rows(df, project, all_vars=all_vars, cast_numeric=cast_numeric)]
 
 
 def check_for_any(df, any_vars, project, cast_numeric=False):
-    exact_match_columns, other_columns = get_variable_column_lists(df.columns, any_vars, project)
-    # flatten because for 'any' we can search all the columns together (just one overall has to be non-null)
-    flattened_other_columns = list(chain.from_iterable(other_columns))
-    df = df.drop(df[
-        df[exact_match_columns].apply(lambda x: pd.to_numeric(x, errors='coerce') if cast_numeric else x).isnull().all(axis=1) & \
-        df[flattened_other_columns].apply(lambda x: pd.to_numeric(x, errors='coerce') if cast_numeric else x).isnull().all(axis=1)
-    ].index)
-    return df
+    return df[get_complete_rows(df, project, any_vars=any_vars, cast_numeric=cast_numeric)]
+
+
+# Gathers values of each (session, column) pair in pairs into wide blocks (one row per participant)
+#   - positions is a participant x session grid of row numbers (-1 where participant has no row for that session)
+#   - complete_sessions marks sessions every participant has a row for (otherwise ints are upcast to float, bools to object, like unstack)
+#   - columns with numpy dtypes go into one preallocated block per dtype, extension dtypes (Int64, category, etc.) one column at a time
+def _gather_blocks(df, positions, pairs, complete_sessions, index):
+    missing = positions < 0
+    dtypes = df.dtypes
+    pairs_by_dtype = {}
+    for session, col in pairs:
+        out_dtype = dtypes[col]
+        if isinstance(out_dtype, np.dtype) and not complete_sessions[session]:
+            out_dtype = { 'i': np.dtype(float), 'u': np.dtype(float), 'b': np.dtype(object) }.get(out_dtype.kind, out_dtype)
+        pairs_by_dtype.setdefault(out_dtype, []).append((session, col))
+
+    blocks = []
+    for out_dtype, dtype_pairs in pairs_by_dtype.items():
+        if not isinstance(out_dtype, np.dtype):
+            for session, col in dtype_pairs:
+                blocks.append(([(session, col)], pd.DataFrame({ 0: df[col].array.take(positions[:, session], allow_fill=True) }, index=index)))
+            continue
+
+        # gather straight from each source column (no intermediate copy of the long frame)
+        block = np.empty((len(dtype_pairs), len(index)), dtype=out_dtype) # one row per output column so each column is contiguous
+        for i, (session, col) in enumerate(dtype_pairs):
+            block[i] = df[col].to_numpy().take(positions[:, session])
+
+        block_missing = missing[:, [ session for session, _ in dtype_pairs ]].T
+        if block_missing.any():
+            block[block_missing] = np.datetime64('NaT') if out_dtype.kind in 'mM' else np.nan
+        blocks.append((dtype_pairs, pd.DataFrame(block.T, index=index, copy=False)))
+    return blocks
 
 
 # re-shape dataframe such that there is one row per participant (each row contains all sessions)
+#   builds the wide layout in one pass: every row is placed by its integer-coded (participant, session) position
 def flatten(df, flatten_by_column, sort=True, prefix=''):
     # assume session_number = 0 is "stable" arm (things that don't change over time)
     # assume session_number > 0 is some longitudinal variable (like session number or clinic year)
-  
-    # select session_number = 0 into df_stable
-    
-    if is_numeric_dtype(df[flatten_by_column]):
-        df_stable = df[df[flatten_by_column]==0]
-    else:
-        df_stable = df[df[flatten_by_column]=='0']
-
-    # drop blank columns???
-    df_stable = df_stable.dropna(axis=1, how='all')
-    
-    df_stable.set_index([STUDY_ID, flatten_by_column], inplace=True)
-    df_stable = df_stable.unstack()
-
-    # select session_number != 0 into df_long
     if is_numeric_dtype(df[flatten_by_column]):
-        df_long = df[df[flatten_by_column]>0]
+        is_stable = (df[flatten_by_column] == 0).values
+        is_long = (df[flatten_by_column] > 0).values
     else:
-        df_long = df[df[flatten_by_column]!='0']
-
-    # drop blank columns???
-    df_long = df_long.dropna(axis=1, how='all')
-
-    df_long.set_index([STUDY_ID, flatten_by_column], inplace=True)
-    df_long = df_long.unstack()
+        is_stable = (df[flatten_by_column] == '0').values
+        is_long = (df[flatten_by_column] != '0').values
+
+    # drop blank columns??? (separately for stable and longitudinal rows)
+    has_data = df.notnull().to_numpy()
+    stable_cols = [ col for col, keep in zip(df.columns, has_data[is_stable].any(axis=0)) if keep and col not in [STUDY_ID, flatten_by_column] ]
+    long_cols = [ col for col, keep in zip(df.columns, has_data[is_long].any(axis=0)) if keep and col not in [STUDY_ID, flatten_by_column] ]
+
+    # integer-coded (participant, session) positions -- stable session is code 0, longitudinal sessions start at 1
+    session_values = df[flatten_by_column].values
+    sessions = pd.unique(session_values[is_long])
+    sessions = sessions[np.argsort(sessions, kind='stable')]
+    session_codes = np.where(is_stable, 0, pd.Index(sessions).get_indexer(session_values) + 1)
+    id_codes, ids = pd.factorize(df[STUDY_ID])
+    in_grid = (is_stable | is_long) & (id_codes >= 0)
+    if pd.Index(id_codes[in_grid] * (len(sessions) + 1) + session_codes[in_grid]).has_duplicates:
+        raise ValueError('Index contains duplicate entries, cannot reshape')
 
+    # Use a left join so participants with stable (session 0) data but no longitudinal
+    # sessions are retained (participants without stable data are dropped)
+    participants = pd.Index(ids[np.unique(id_codes[is_stable & in_grid])], name=STUDY_ID).sort_values()
+    participant_codes = participants.get_indexer(df[STUDY_ID])
+    keep = in_grid & (participant_codes >= 0)
+    positions = np.full((len(participants), len(sessions) + 1), -1, dtype=np.intp)
+    positions[participant_codes[keep], session_codes[keep]] = np.flatnonzero(keep)
+
+    session_order = range(1, len(sessions) + 1)
+    stable_pairs = [ (0, col) for col in (sorted(stable_cols) if sort else stable_cols) ]
     if sort:
-        df_stable = df_stable.sort_index(1, level=1)
-        df_long = df_long.sort_index(1, level=1)
-    df_stable.columns = [ '_'.join([prefix + str(tup[1]), tup[0]]) for tup in df_stable.columns ] # append unstacked index to front of column name
-    df_long.columns = [ '_'.join([prefix + str(tup[1]), tup[0]]) for tup in df_long.columns ]
+        long_pairs = [ (session, col) for session in session_order for col in sorted(long_cols) ]
+    else:
+        long_pairs = [ (session, col) for col in long_cols for session in session_order ]
 
-    # merge stable and long back together
-    # Use a left join so participants with stable (session 0) data but no longitudinal
-    # sessions are retained instead of being dropped (previously 'inner' dropped them).
-    df = pd.merge(df_stable, df_long, how='left', on=STUDY_ID)
+    stable_label = session_values[is_stable][0] if is_stable.any() else 0
+    session_labels = [ prefix + str(label) for label in chain([stable_label], sessions) ]
+    names = { pair: '_'.join([session_labels[pair[0]], pair[1]]) for pair in chain(stable_pairs, long_pairs) } # append session to front of column name
 
     # remove s0_clinic_year and s0_session_number
-    df = df.drop(['{}0_clinic_year'.format(prefix)], axis=1, errors='ignore')
-    df = df.drop(['{}0_wolfram_sessionnumber'.format(prefix)], axis=1, errors='ignore')
+    drop_names = ['{}0_clinic_year'.format(prefix), '{}0_wolfram_sessionnumber'.format(prefix)]
+    stable_pairs = [ pair for pair in stable_pairs if names[pair] not in drop_names ]
+    long_pairs = [ pair for pair in long_pairs if names[pair] not in drop_names ]
+
+    # stable session always complete, longitudinal sessions are upcast together (like unstack, then left merge onto stable rows) if any participant
+    # with longitudinal rows is missing any session (whether or not they have stable rows), or any participant with stable rows has no longitudinal rows
+    long_rows = is_long & in_grid
+    all_long_sessions = long_rows.sum() == len(np.unique(id_codes[long_rows])) * len(sessions)
+    complete_sessions = [True] + [all_long_sessions and (positions[:, 1:] >= 0).any(axis=1).all()] * len(sessions)
+    blocks = _gather_blocks(df, positions, stable_pairs + long_pairs, complete_sessions, participants)
+    columns = [ names[pair] for pair in stable_pairs + long_pairs ]
+    if not blocks:
+        return pd.DataFrame(index=participants, columns=columns)
+
+    for block_pairs, block in blocks:
+        block.columns = [ names[pair] for pair in block_pairs ]
+    df = pd.concat([ block for _, block in blocks ], axis=1, copy=False) if len(blocks) > 1 else blocks[0][1]
+    return df if list(df.columns) == columns else df[columns]
 
-    return df
 
 # re-shape dataframe such that there is one row per participant (each row contains all sessions)
 def simple_flatten(df, sort=True, prefix=''):
@@ -265,10 +760,83 @@ def expand(df):
     return df.rename(columns={'level_0': STUDY_ID, 'level_1': SESSION_NUMBER}), non_session_cols
 
 
-def write_results_and_open(df, output_file):
+# Combined dtype for a column that was read in pieces (int + float becomes float, anything else mixed becomes object)
+def _combine_dtypes(dtype1, dtype2):
+    if dtype1 is None or dtype1 == dtype2:
+        return dtype2
+    if dtype1.kind in 'iuf' and dtype2.kind in 'iuf':
+        return np.dtype(float)
+    return np.dtype(object)
+
+
+# Streaming version of expand -- reads wide csv in row chunks and appends each expanded chunk to output_file
+#   - first column of input_file should contain subject ids
+#   - renames, column renames to apply before expanding (i.e. session suffix -> prefix)
+#   - makes two passes over input_file so column types agree across chunks (output matches expand on the whole file)
+def expand_csv(input_file, output_file, renames=None, chunksize=1000):
+    # first pass: get types each column would have if the whole file was read (and expanded) at once
+    input_dtypes, output_dtypes = {}, {}
+    for chunk in pd.read_csv(input_file, index_col=0, chunksize=chunksize):
+        input_dtypes = { col: _combine_dtypes(input_dtypes.get(col), dtype) for col, dtype in chunk.reset_index().dtypes.items() }
+        expanded, non_session_cols = expand(chunk.rename(columns=renames) if renames else chunk)
+        output_dtypes = { col: _combine_dtypes(output_dtypes.get(col), dtype) for col, dtype in expanded.dtypes.items() }
+    read_dtypes = { col: dtype for col, dtype in input_dtypes.items() if dtype.kind in 'fO' } # ints that are fine in every chunk are left to be inferred
+
+    # second pass: expand and write each chunk
+    for i, chunk in enumerate(pd.read_csv(input_file, index_col=0, chunksize=chunksize, dtype=read_dtypes)):
+        expanded, non_session_cols = expand(chunk.rename(columns=renames) if renames else chunk)
+        expanded = expanded.astype({ col: dtype for col, dtype in output_dtypes.items() if expanded[col].dtype != dtype })
+        expanded.to_csv(output_file, mode='w' if i == 0 else 'a', header=(i == 0), index=False)
+    return non_session_cols
+
+
+# Write results in format given by fmt (or output_file extension if not given -- see FILE_FORMATS)
+#   - csv formats are compressed based on extension (.gz/.zst)
+#   - parquet/feather store index as regular columns (same layout as csv), and need string column names
+def write_df(df, output_file, fmt=None):
+    fmt = fmt or get_file_format(output_file)
+    if fmt not in COLUMNAR_FORMATS:
+        df.to_csv(output_file, compression='infer')
+        return
+
+    df = df.reset_index() if not isinstance(df.index, pd.RangeIndex) else df
+    df = df.set_axis(df.columns.map(str), axis=1)
+
+    # columns mixing text and numbers (i.e. transposed results, where each column is a participant) are stored as text
+    mixed_cols = [ col for col in df.columns if df[col].dtype == object and pd.api.types.infer_dtype(df[col], skipna=True) in ['mixed', 'mixed-integer'] ]
+    if mixed_cols:
+        df = df.copy()
+        for col in mixed_cols:
+            df[col] = df[col].where(df[col].isnull(), df[col].astype(str))
+
+    if fmt == 'parquet':
+        df.to_parquet(output_file, index=False)
+    else:
+        df.to_feather(output_file)
+
+
+# Output filename for format (replaces extension of output_file if it doesn't match)
+def get_output_file(output_file, fmt=None):
+    if not fmt or get_file_format(output_file) == fmt:
+        return output_file
+    return '.'.join([strip_file_format(output_file), fmt])
+
+
+def write_results_and_open(df, output_file, fmt=None):
+    output_file = get_output_file(output_file, fmt)
+    write_and_open(lambda f: write_df(df, f, fmt), output_file)
+
+
+OPEN_RESULTS = True # set to False to only write results (i.e. in batch runs)
+
+# Writes results with write(output_file) (i.e. a streaming writer) and then opens output_file (only plain csv is opened, other formats aren't meant for a spreadsheet program)
+def write_and_open(write, output_file):
     try:
-        df.to_csv(output_file)
-        Popen(output_file, shell=True)
+        write(output_file)
+        if get_file_format(output_file) == 'csv' and OPEN_RESULTS:
+            Popen(output_file, shell=True)
+        else:
+            print('### Results written to {} ###'.format(output_file))
     except PermissionError:
         stderr.write('Output file is currently open. Please close the file before trying again.')
         exit(1)
@@ -0,0 +1,100 @@
+import json
+import os
+import pandas as pd
+import sys
+import time
+import redcap_common
+import tracemalloc
+
+from contextlib import contextmanager
+
+try:
+    import resource # not available on Windows (peak RSS comes from psutil there, if installed)
+except ImportError:
+    resource = None
+
+# Opt-in per-stage instrumentation for the formatting scripts
+#   - each stage records wall time, rows/columns in and out, peak RSS (and how much the stage raised it), and memory allocated during the stage (tracemalloc)
+#   - tracemalloc is started fresh for each stage, so traced_delta_mb is memory still held from the stage's allocations at the end,
+#     and traced_peak_mb is the most the stage had allocated at once (stages shouldn't be nested)
+#   - when disabled, stages are no-ops (tracemalloc slows everything down, so it only runs when profiling)
+#   - profile is written next to output as <output>_profile.json and <output>_profile.csv
+
+PROFILE_COLUMNS = ['stage', 'seconds', 'rows_in', 'columns_in', 'rows_out', 'columns_out', 'peak_rss_mb', 'peak_rss_delta_mb', 'traced_delta_mb', 'traced_peak_mb']
+
+
+def get_peak_rss():
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024 # bytes on macOS, KB on Linux
+    try:
+        import psutil
+    except ImportError:
+        return None
+    memory = psutil.Process().memory_info()
+    return getattr(memory, 'peak_wset', memory.rss) / 1024**2
+
+
+def get_shape(df):
+    return df.shape if isinstance(df, pd.DataFrame) else (None, None)
+
+
+class Stage:
+    def __init__(self, name, df=None):
+        self.record = { 'stage': name }
+        self.record['rows_in'], self.record['columns_in'] = get_shape(df)
+        self.record['rows_out'], self.record['columns_out'] = None, None
+
+    # dataframe stage produced (shape is recorded when stage ends)
+    def output(self, df):
+        self.record['rows_out'], self.record['columns_out'] = get_shape(df)
+        return df
+
+
+class NullStage:
+    def output(self, df):
+        return df
+
+
+class Profiler:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stages = []
+
+    # with profiler.stage('filter', df) as stage: ...; stage.output(df)
+    @contextmanager
+    def stage(self, name, df=None):
+        if not self.enabled:
+            yield NullStage()
+            return
+
+        stage = Stage(name, df)
+        rss_before = get_peak_rss()
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage.record['seconds'] = round(time.perf_counter() - start, 4)
+            traced, traced_peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            rss_after = get_peak_rss()
+            stage.record['peak_rss_mb'] = round(rss_after, 1) if rss_after is not None else None
+            stage.record['peak_rss_delta_mb'] = round(rss_after - rss_before, 1) if rss_after is not None else None
+            stage.record['traced_delta_mb'] = round(traced / 1024**2, 1)
+            stage.record['traced_peak_mb'] = round(traced_peak / 1024**2, 1)
+            self.stages.append(stage.record)
+
+    # Writes <output root>_profile.json/.csv (returns their paths), nothing if profiling is disabled
+    def write(self, output_file):
+        if not self.enabled:
+            return []
+
+        root = redcap_common.strip_file_format(output_file)
+        json_file, csv_file = root + '_profile.json', root + '_profile.csv'
+        with open(json_file, 'w') as f:
+            json.dump({ 'output_file': output_file, 'stages': self.stages }, f, indent=2)
+        profile_df = pd.DataFrame(self.stages, columns=PROFILE_COLUMNS)
+        profile_df.astype({ col: 'Int64' for col in ['rows_in', 'columns_in', 'rows_out', 'columns_out'] }).to_csv(csv_file, index=False)
+        print('### Stage profile written to {} ###'.format(csv_file))
+        return [json_file, csv_file]
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# scripts are run from the repo root (not installed), so make them importable the same way
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# keep the user's REDCap cache out of tests (set before redcap_cache is imported, it reads this once)
+os.environ['REDCAP_CACHE_DIR'] = tempfile.mkdtemp(prefix='redcap_cache_test_')
@@ -0,0 +1,54 @@
+import pandas as pd
+import pytest
+
+from datetime import datetime, timedelta
+
+import redcap_cache
+import redcap_common
+import redcap_export
+from tools import fake_redcap_server
+
+
+@pytest.fixture
+def server(tmp_path):
+    records_file = tmp_path / 'export.csv'
+    pd.DataFrame({ 'record_id': ['1', '1', '2', '3'], 'redcap_event_name': ['year_1_arm_1', 'year_2_arm_1', 'year_1_arm_1', 'year_1_arm_1'], 'value': ['a', 'b', 'c', 'd'] }).to_csv(records_file, index=False)
+    server, url = fake_redcap_server.start_server(str(records_file))
+    yield server, redcap_common.get_redcap_project(None, 'A' * 32, url), str(tmp_path / 'cache')
+    server.shutdown()
+
+
+def export(project, cache_dir, prune_deleted=False):
+    return redcap_cache.export_records_cached(project, ['value'], prune_deleted=prune_deleted, cache_dir=cache_dir, export_records=redcap_export.export_records)
+
+
+def test_changes_found_when_local_clock_is_ahead(server, monkeypatch):
+    server, project, cache_dir = server
+
+    class AheadDatetime(datetime): # this computer's clock an hour ahead of the server
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.now(tz) + timedelta(hours=1)
+    monkeypatch.setattr(redcap_cache, 'datetime', AheadDatetime)
+    export(project, cache_dir)
+
+    server.redcap.import_records({ 'data': ['record_id,redcap_event_name,value\n2,year_1_arm_1,changed\n'], 'format': ['csv'] })
+    df = export(project, cache_dir)
+    assert df.loc[(2, 'year_1_arm_1'), 'value'] == 'changed'
+
+
+def test_deleted_records_only_pruned_when_asked(server):
+    server, project, cache_dir = server
+    export(project, cache_dir)
+    with server.redcap.lock:
+        server.redcap.records = server.redcap.records[server.redcap.records['record_id'] != '3']
+        server.redcap.modified = server.redcap.modified.drop('3')
+
+    requests_before = server.redcap.request_count
+    assert 3 in export(project, cache_dir).index.get_level_values(0)
+    requests_plain = server.redcap.request_count - requests_before
+
+    requests_before = server.redcap.request_count
+    df = export(project, cache_dir, prune_deleted=True)
+    assert list(df.index.get_level_values(0).unique()) == [1, 2]
+    assert server.redcap.request_count - requests_before > requests_plain # record ids were exported
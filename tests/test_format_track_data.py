@@ -0,0 +1,59 @@
+import os
+import pandas as pd
+import subprocess
+import sys
+
+from tools import fake_redcap_server
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Wide TRACK-style export (session fields prefixed s<n>_, sessions that weren't attended are blank) plus a test row
+def write_export(path, num_participants=8):
+    rows = []
+    for i in range(1, num_participants + 1):
+        row = { 'track_id': 'TRACK{}'.format(i), 'sex': 1 + i % 2, 'dob': '200{}-03-15'.format(i % 10), 'db_dx_date': '2010-01-01', 'db_onset_age': 2 + i / 2 }
+        for session in range(1, 4):
+            attended = session == 1 or (i + session) % 3 != 0
+            row['s{}_physicalexam_date'.format(session)] = '{}-06-01'.format(2014 + session) if attended else ''
+            row['s{}_weight'.format(session)] = 20 + i + session if attended else ''
+        rows.append(row)
+    rows.append(dict(rows[0], track_id='test'))
+    pd.DataFrame(rows).to_csv(path, index=False)
+
+
+def run_track(args, env=None):
+    return subprocess.run([sys.executable, os.path.join(REPO_DIR, 'format_track_data.py'), '--headless'] + args, cwd=REPO_DIR, env=dict(os.environ, **(env or {})),
+        stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=300)
+
+
+def test_batch(tmp_path):
+    for name in ['track_a.csv', 'track_b.csv']:
+        write_export(tmp_path / name)
+
+    result = run_track(['--batch', str(tmp_path), '--workers', '2'])
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert '2 of 2 files processed successfully' in result.stdout
+
+    df = pd.read_csv(tmp_path / 'track_a_formatted.csv', index_col=0)
+    assert list(df.index) == [ 'TRACK{}'.format(i) for i in range(1, 9) ] # test row removed
+    assert { 'dob', 'sex', 's1_weight', 's2_weight', 's3_physicalexam_date' } <= set(df.columns) # non-session columns without session prefix
+    assert df.loc['TRACK2', 's3_weight'] == 25 and pd.isnull(df.loc['TRACK1', 's2_weight'])
+
+
+def test_duration_and_consecutive(tmp_path):
+    export_file = tmp_path / 'exports' / 'track.csv'
+    export_file.parent.mkdir()
+    write_export(export_file)
+    server, url = fake_redcap_server.start_server(str(export_file))
+    try:
+        result = run_track(['--batch', str(export_file.parent), '--api_token', 'A' * 32, '--duration', '--consecutive', '2'],
+            env={ 'REDCAP_API_URL': url, 'REDCAP_CACHE_DIR': str(tmp_path / 'cache') })
+    finally:
+        server.shutdown()
+    assert result.returncode == 0, result.stdout + result.stderr
+
+    df = pd.read_csv(tmp_path / 'exports' / 'track_formatted.csv', index_col=0)
+    assert 'TRACK1' not in df.index # only attended 2015 and 2017, not consecutive
+    age = (pd.Timestamp('2016-06-01') - pd.Timestamp(df.loc['TRACK2', 'dob'])).days / 365.25
+    assert abs(df.loc['TRACK2', 's2_dx_db_duration'] - (age - df.loc['TRACK2', 'db_onset_age'])) < 1e-9
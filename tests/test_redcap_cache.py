@@ -0,0 +1,53 @@
+import os
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+
+import redcap_cache
+
+ITERATIONS = 200
+
+
+def get_df():
+    return pd.DataFrame({ 'record_id': range(50), 'value': [ str(i) for i in range(50) ] }).set_index('record_id')
+
+
+# Reads and writes one key over and over (like --batch workers sharing stage cache), returns number of hits
+def use_cache(cache_dir, key):
+    hits = 0
+    for i in range(ITERATIONS):
+        df, info = redcap_cache.read_cache(key, cache_dir)
+        if df is None:
+            redcap_cache.write_cache(key, get_df(), { 'stage': 'test' }, cache_dir)
+        else:
+            pd.testing.assert_frame_equal(df, get_df())
+            assert info == { 'stage': 'test' }
+            hits += 1
+    return hits
+
+
+def test_workers_share_cache_key(tmp_path):
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        hits = [ future.result() for future in [ executor.submit(use_cache, str(tmp_path), 'stage_shared') for _ in range(2) ] ]
+    assert sum(hits) > 0
+
+
+def test_unreadable_info_file_is_cache_miss(tmp_path):
+    redcap_cache.write_cache('stage_broken', get_df(), { 'stage': 'test' }, str(tmp_path))
+    _, info_file = redcap_cache.get_cache_paths('stage_broken', str(tmp_path))
+    open(info_file, 'w').close() # truncated, as if another process was part way through writing it
+
+    assert redcap_cache.read_cache('stage_broken', str(tmp_path)) == (None, None)
+    redcap_cache.enforce_size_limit(str(tmp_path), size_limit=0)
+
+
+def test_size_limit_removes_least_recently_used(tmp_path):
+    cache_dir = str(tmp_path)
+    for key in ['stage_a', 'stage_b']:
+        redcap_cache.write_cache(key, get_df(), {}, cache_dir)
+    size = sum(os.path.getsize(path) for path in redcap_cache.get_cache_paths('stage_a', cache_dir))
+
+    os.utime(redcap_cache.get_cache_paths('stage_b', cache_dir)[0], (0, 0)) # b last used long ago
+    redcap_cache.enforce_size_limit(cache_dir, size_limit=size)
+    assert redcap_cache.read_cache('stage_a', cache_dir)[0] is not None
+    assert redcap_cache.read_cache('stage_b', cache_dir) == (None, None)
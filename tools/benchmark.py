@@ -0,0 +1,189 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(sys.argv[0])))) # repo root
+os.environ['REDCAP_CACHE_DIR'] = tempfile.mkdtemp() # schema snapshots for the synthetic project stay out of the real cache
+import format_wolfram_data
+import redcap_common
+
+from generate_redcap_export import generate_export, write_export
+
+# Times and memory-profiles the formatting pipeline on synthetic exports (see generate_redcap_export.py)
+#   - each stage is run on a fresh copy of its input (setup isn't timed), best time of --repeat runs is reported
+#   - peak memory is measured (with tracemalloc) in a separate run so it doesn't skew timings
+#   - results can be saved as a baseline, and later runs are compared against it
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+SIZES = [1000, 10000, 100000]
+CONSECUTIVE_YEARS = 3
+ALL_VARS = ['measure_0', 'ratings'] # variable + form
+ANY_VARS = ['symptom_0', 'mri_date']
+MAX_PARTICIPANTS = { 'get_consecutive_years': 10000 } # legacy groupby/apply version takes too long beyond this (superseded by the mask)
+
+
+# Stand-in for a PyCap project, only used to build the schema snapshot for check_for_all/check_for_any
+class SyntheticProject:
+    def __init__(self, metadata):
+        self.url = 'synthetic'
+        self.token = str(len(metadata))
+        self.metadata = metadata
+
+    def export_metadata(self):
+        return self.metadata
+
+
+# Session-level frame (common column names, year from event) like the scripts build before age/consecutive calculations
+def get_sessions(df, metadata, tmpdir):
+    df = df.rename(columns={ 'clinic_date': redcap_common.SESSION_DATE, 'wolfram_sessionnumber': redcap_common.SESSION_NUMBER })
+    df[redcap_common.SESSION_YEAR] = pd.to_numeric(df['redcap_event_name'].str[0:4], errors='coerce')
+    return (df,)
+
+
+# Frame format_wolfram_data passes to flatten (stable rows are session 0, unattended sessions removed)
+def get_flatten_input(df, metadata, tmpdir):
+    df = df.copy()
+    df.loc[df['redcap_event_name'] == 'stable_arm_1', 'wolfram_sessionnumber'] = 0
+    df = df[pd.notnull(df['wolfram_sessionnumber']) & pd.isnull(df['missed_session'])]
+    df['wolfram_sessionnumber'] = df['wolfram_sessionnumber'].astype(int)
+    return (df.drop(columns=['redcap_event_name']),)
+
+
+def get_expand_input(df, metadata, tmpdir):
+    return (flatten(*get_flatten_input(df, metadata, tmpdir)),) # indexed by participant, like redcap2spss input
+
+
+def get_completeness_input(df, metadata, tmpdir):
+    return (df, SyntheticProject(metadata))
+
+
+def get_pipeline_input(df, metadata, tmpdir):
+    input_file = os.path.join(tmpdir, 'export.csv')
+    write_export(df, metadata, input_file)
+    return (input_file,)
+
+
+def flatten(df):
+    return redcap_common.flatten(df, 'wolfram_sessionnumber', True, 's')
+
+
+def run_pipeline(input_file):
+    argv = sys.argv
+    sys.argv = ['format_wolfram_data.py', '--headless', '--input_file', input_file, '-f', '-c', str(CONSECUTIVE_YEARS), '--output_format', 'parquet', '--no_cache']
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            format_wolfram_data.format_wolfram_data()
+    finally:
+        sys.argv = argv
+
+
+# stage -> (prepare, run)
+#   - prepare(export, metadata, tmpdir) builds stage input once per size (not timed), as tuple of arguments for run
+#   - run(*args) is what is timed (dataframe arguments are copied before each run, since some stages modify them)
+STAGES = {
+    'prepare_age_calc': (get_sessions, redcap_common.prepare_age_calc),
+    'get_consecutive_years': (get_sessions, lambda df: df.groupby(redcap_common.STUDY_ID).apply(redcap_common.get_consecutive_years, CONSECUTIVE_YEARS)),
+    'get_consecutive_years_mask': (get_sessions, lambda df: redcap_common.get_consecutive_years_mask(df, CONSECUTIVE_YEARS)),
+    'flatten': (get_flatten_input, flatten),
+    'expand': (get_expand_input, redcap_common.expand),
+    'check_for_all': (get_completeness_input, lambda df, project: redcap_common.check_for_all(df, ALL_VARS, project)),
+    'check_for_any': (get_completeness_input, lambda df, project: redcap_common.check_for_any(df, ANY_VARS, project)),
+    'format_wolfram_data': (get_pipeline_input, run_pipeline),
+}
+
+
+def copy_args(args):
+    return [ arg.copy() if isinstance(arg, pd.DataFrame) else arg for arg in args ]
+
+
+def measure(run, args, repeat):
+    times = []
+    for _ in range(repeat):
+        run_args = copy_args(args)
+        start = time.perf_counter()
+        run(*run_args)
+        times.append(time.perf_counter() - start)
+
+    run_args = copy_args(args)
+    tracemalloc.start()
+    run(*run_args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak / 1024**2
+
+
+def run_benchmarks(sizes, stages, repeat=3, seed=0):
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for size in sizes:
+            df, metadata = generate_export(size, seed=seed)
+            for stage in stages:
+                if size > MAX_PARTICIPANTS.get(stage, size):
+                    continue
+                prepare, run = STAGES[stage]
+                seconds, peak_mb = measure(run, prepare(df, metadata, tmpdir), repeat)
+                results.append({ 'stage': stage, 'participants': size, 'rows': len(df), 'seconds': round(seconds, 4), 'peak_mb': round(peak_mb, 1) })
+                print('{:<28} {:>7} participants {:>9.3f}s {:>9.1f} MB'.format(stage, size, seconds, peak_mb))
+    return results
+
+
+def get_info():
+    return { 'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__, 'platform': platform.platform(), 'time': time.strftime('%Y-%m-%d %H:%M:%S') }
+
+
+# Adds results to existing baseline (replacing entries for the same stage/size), so sizes/stages can be recorded in separate runs
+def merge_baseline(report, baseline_file):
+    if not os.path.exists(baseline_file):
+        return report
+
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    new_keys = set((r['stage'], r['participants']) for r in report['results'])
+    results = [ r for r in baseline['results'] if (r['stage'], r['participants']) not in new_keys ] + report['results']
+    return { 'info': report['info'], 'results': sorted(results, key=lambda r: (r['participants'], list(STAGES).index(r['stage']))) }
+
+
+# Prints time/memory ratio against baseline for each stage/size in both
+def compare(results, baseline):
+    base = { (r['stage'], r['participants']): r for r in baseline['results'] }
+    print('\nCompared to baseline ({}):'.format(baseline['info']['time']))
+    for r in results:
+        b = base.get((r['stage'], r['participants']))
+        if b:
+            print('{:<28} {:>7} participants  time x{:.2f}  memory x{:.2f}'.format(r['stage'], r['participants'],
+                r['seconds'] / b['seconds'] if b['seconds'] else np.nan, r['peak_mb'] / b['peak_mb'] if b['peak_mb'] else np.nan))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the formatting pipeline on synthetic REDCap exports')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='numbers of participants to benchmark')
+    parser.add_argument('--stages', nargs='+', default=list(STAGES.keys()), choices=list(STAGES.keys()))
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage (best is reported)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='json file to write results to')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='baseline json to compare against')
+    parser.add_argument('--save_baseline', action='store_true', help='save results to baseline (instead of comparing) -- replaces baseline entries for the same stages/sizes')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.stages, args.repeat, args.seed)
+    report = { 'info': get_info(), 'results': results }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        baseline = merge_baseline(report, args.baseline)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
@@ -3,11 +3,14 @@ import os
 import pandas as pd
 import re
 import shutil
+import sys
 
 from glob import glob
-from gooey import Gooey, GooeyParser
 from zipfile import ZipFile
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(sys.argv[0])))) # repo root (for gooey_common)
+from gooey_common import Gooey, GooeyParser
+
 def get_processed_jobs(outdir):
     job_map = {}
     reports = glob(os.path.join(outdir, '*_report.csv'))
@@ -0,0 +1,182 @@
+import argparse
+import io
+import json
+import os
+import pandas as pd
+import sys
+import threading
+import time
+
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # repo root (for redcap_cache)
+from redcap_cache import METADATA_KEYS, read_data_dictionary
+
+# Local stand-in for the REDCap API (enough of it for the scripts in this repo)
+#   - serves records from a REDCap csv export, and metadata from a data dictionary csv (if given)
+#   - supports record export/import (with dateRangeBegin/dateRangeEnd filtering), metadata, field names, events, arms, form/event mapping, version
+#   - latency (seconds) is added to every request to mimic a remote server
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Minimal data dictionary (every field is text on a single form) for when no dictionary file is given
+def build_metadata(records_df):
+    fields = list(dict.fromkeys(col.split('___')[0] for col in records_df.columns if not col.startswith('redcap_')))
+    return [ dict({ key: '' for key in METADATA_KEYS }, field_name=field, form_name='form_1', field_type='text') for field in fields ]
+
+
+# REDCap accepts list params as "fields[0]=a&fields[1]=b" or "fields=a,b"
+def get_list_param(params, name):
+    values = [ v for key in sorted(params, key=lambda k: int(k[len(name)+1:-1]) if k.startswith(name + '[') else -1) if key.startswith(name + '[') for v in params[key] ]
+    if not values and name in params:
+        values = [ v.strip() for v in params[name][0].split(',') if v.strip() ]
+    return values
+
+
+class FakeRedcap:
+    def __init__(self, records_df, metadata, latency=0):
+        self.lock = threading.Lock()
+        self.records = records_df.astype(str).replace('nan', '')
+        self.record_id = self.records.columns[0]
+        self.modified = pd.Series(datetime.now(), index=self.records[self.record_id].unique())
+        self.metadata = metadata
+        self.latency = latency
+        self.request_count = 0
+
+    def export_records(self, params):
+        records = get_list_param(params, 'records')
+        fields = get_list_param(params, 'fields')
+        begin = params.get('dateRangeBegin', [''])[0]
+        end = params.get('dateRangeEnd', [''])[0]
+
+        with self.lock:
+            df = self.records
+            modified = self.modified
+        if begin:
+            modified = modified[modified >= datetime.strptime(begin, DATE_FORMAT)]
+        if end:
+            modified = modified[modified <= datetime.strptime(end, DATE_FORMAT)]
+        df = df[df[self.record_id].isin(modified.index)]
+        if records:
+            df = df[df[self.record_id].isin(records)]
+        if fields:
+            keep = [ col for col in df.columns if col == self.record_id or col.startswith('redcap_') or col.split('___')[0] in fields ]
+            df = df[keep]
+        return df
+
+    def import_records(self, params):
+        data = params['data'][0]
+        fmt = params.get('format', ['json'])[0]
+        new_df = pd.read_csv(io.StringIO(data), dtype=str) if fmt == 'csv' else pd.DataFrame(json.loads(data)).astype(str)
+        keys = [ col for col in [self.record_id, 'redcap_event_name'] if col in new_df.columns ]
+        with self.lock:
+            df = self.records.set_index(keys)
+            new_df = new_df.set_index(keys)
+            df = df.reindex(df.index.union(new_df.index), fill_value='')
+            df.update(new_df)
+            self.records = df.reset_index()[self.records.columns]
+            self.modified = self.modified.reindex(self.records[self.record_id].unique())
+            self.modified[new_df.index.get_level_values(0).unique()] = datetime.now()
+        return { 'count': len(new_df.index.get_level_values(0).unique()) }
+
+    def export_events(self):
+        if 'redcap_event_name' not in self.records.columns:
+            return []
+        events = self.records['redcap_event_name'].unique()
+        return [ { 'event_name': event, 'arm_num': int(event.rsplit('_', 1)[-1]) if event.rsplit('_', 1)[-1].isdigit() else 1, 'unique_event_name': event } for event in events ]
+
+    def handle(self, params):
+        time.sleep(self.latency)
+        with self.lock:
+            self.request_count += 1
+
+        content = params.get('content', [''])[0]
+        action = params.get('action', ['export'])[0]
+        if content == 'record' and action == 'import':
+            return self.import_records(params)
+        if content == 'record':
+            return self.export_records(params)
+        if content == 'metadata':
+            forms = get_list_param(params, 'forms')
+            fields = get_list_param(params, 'fields')
+            return [ field for field in self.metadata if (not forms or field['form_name'] in forms) and (not fields or field['field_name'] in fields) ]
+        if content == 'exportFieldNames':
+            return [ { 'original_field_name': field['field_name'], 'choice_value': '', 'export_field_name': field['field_name'] } for field in self.metadata ]
+        if content == 'event':
+            return self.export_events()
+        if content == 'formEventMapping': # PyCap 2 asks for this to tell if project is longitudinal (classic projects return an error)
+            if 'redcap_event_name' not in self.records.columns:
+                raise ValueError('You cannot export form/event mappings for classic projects')
+            forms = list(dict.fromkeys(field['form_name'] for field in self.metadata))
+            return [ { 'arm_num': event['arm_num'], 'unique_event_name': event['unique_event_name'], 'form': form } for event in self.export_events() for form in forms ]
+        if content == 'arm':
+            return [ { 'arm_num': num, 'name': 'Arm {}'.format(num) } for num in sorted(set(event['arm_num'] for event in self.export_events())) ]
+        if content == 'version':
+            return '10.0.0'
+        if content == 'project':
+            return { 'project_id': 1, 'project_title': 'Fake REDCap', 'is_longitudinal': int('redcap_event_name' in self.records.columns) }
+        raise ValueError('Unsupported content: {}'.format(content))
+
+
+def make_handler(redcap):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+            params = parse_qs(body, keep_blank_values=True)
+            try:
+                result = redcap.handle(params)
+            except (KeyError, ValueError) as e:
+                self.respond(400, 'application/json', json.dumps({ 'error': str(e) }))
+                return
+
+            if isinstance(result, pd.DataFrame):
+                if params.get('format', ['json'])[0] == 'csv':
+                    self.respond(200, 'text/csv', result.to_csv(index=False))
+                else:
+                    self.respond(200, 'application/json', result.to_json(orient='records'))
+            elif isinstance(result, str):
+                self.respond(200, 'text/plain', result)
+            else:
+                self.respond(200, 'application/json', json.dumps(result))
+
+        def respond(self, status, content_type, text):
+            data = text.encode()
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+# Start server in background thread, returns (server, api url) -- call server.shutdown() when done
+def start_server(records_file, dictionary_file=None, port=0, latency=0):
+    records_df = pd.read_csv(records_file, dtype=str)
+    metadata = read_data_dictionary(dictionary_file)['metadata'] if dictionary_file else build_metadata(records_df)
+    redcap = FakeRedcap(records_df, metadata, latency)
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(redcap))
+    server.redcap = redcap
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}/api/'.format(server.server_address[1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the REDCap API (any token is accepted)')
+    parser.add_argument('records_file', help='REDCap csv export to serve')
+    parser.add_argument('--dictionary', help='data dictionary csv (if not given, every field is treated as text on one form)')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to each request')
+    args = parser.parse_args()
+
+    server, url = start_server(args.records_file, args.dictionary, args.port, args.latency)
+    print('Serving fake REDCap API at {} (REDCAP_API_URL)'.format(url))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
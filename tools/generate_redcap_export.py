@@ -0,0 +1,133 @@
+import argparse
+import numpy as np
+import os
+import pandas as pd
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # repo root (for redcap_cache)
+from redcap_cache import METADATA_KEYS
+
+# Synthetic Wolfram-style REDCap export (and matching data dictionary) for benchmarking/testing the formatting scripts
+#   - one stable event per participant (dob and other stable fields), then yearly clinic events (<year>_arm_1) from enrollment on
+#     (some years are skipped), plus occasional mini-clinic events (mini_clinic_<n>_arm_1)
+#   - clinic events have clinic_date, wolfram_sessionnumber, a few missed sessions (missed_session = 1), some mri dates,
+#     numeric and radio fields, and checkbox families (field___<code>)
+
+STABLE_EVENT = 'stable_arm_1'
+FIRST_YEAR = 2010
+NUM_YEARS = 10
+ATTEND_RATE = 0.8 # chance of attending each clinic year after enrollment
+MISSED_RATE = 0.03 # chance an attended year is flagged as a missed session instead
+MINI_CLINIC_RATE = 0.1 # chance a participant has a mini-clinic
+MRI_RATE = 0.6 # chance a session includes an mri
+MISSING_RATE = 0.1 # chance a measure is blank in a session
+CHECKBOX_OPTIONS = 4
+
+
+def get_field(name, form, field_type, choices='', validation=''):
+    return dict({ key: '' for key in METADATA_KEYS }, field_name=name, form_name=form, field_type=field_type, field_label=name.replace('_', ' ').title(),
+        select_choices_or_calculations=choices, text_validation_type_or_show_slider_number=validation)
+
+
+# Data dictionary (list of field dicts, like project.export_metadata()) for an export with num_numeric/num_radio/num_checkbox clinic measures
+def generate_metadata(num_numeric=20, num_radio=10, num_checkbox=5):
+    choices = ' | '.join('{0}, Option {0}'.format(code) for code in range(1, CHECKBOX_OPTIONS + 1))
+    metadata = [
+        get_field('study_id', 'demographics', 'text'),
+        get_field('dob', 'demographics', 'text', validation='date_ymd'),
+        get_field('sex', 'demographics', 'radio', '1, Male | 2, Female'),
+        get_field('clinic_date', 'clinic_visit', 'text', validation='date_ymd'),
+        get_field('wolfram_sessionnumber', 'clinic_visit', 'text', validation='integer'),
+        get_field('missed_session', 'clinic_visit', 'yesno'),
+        get_field('mri_date', 'mri', 'text', validation='date_ymd'),
+    ]
+    metadata += [ get_field('measure_{}'.format(i), 'measures', 'text', validation='number') for i in range(num_numeric) ]
+    metadata += [ get_field('rating_{}'.format(i), 'ratings', 'radio', choices) for i in range(num_radio) ]
+    metadata += [ get_field('symptom_{}'.format(i), 'symptoms', 'checkbox', choices) for i in range(num_checkbox) ]
+    return metadata
+
+
+def get_dates(years, rng):
+    return pd.to_datetime((np.asarray(years) - 1970).astype('datetime64[Y]')) + pd.to_timedelta(rng.integers(0, 365, len(years)), unit='D')
+
+
+# Generates export for num_participants, returns (records dataframe in REDCap export column order, metadata)
+def generate_export(num_participants, num_numeric=20, num_radio=10, num_checkbox=5, first_year=FIRST_YEAR, num_years=NUM_YEARS, seed=0):
+    rng = np.random.default_rng(seed)
+    metadata = generate_metadata(num_numeric, num_radio, num_checkbox)
+    ids = np.array([ 'WOLF_{:05d}_ST'.format(i) for i in range(num_participants) ])
+    enroll_years = rng.integers(first_year, first_year + num_years, num_participants)
+    dobs = get_dates(enroll_years - rng.integers(5, 30, num_participants), rng)
+
+    # clinic years: every year from enrollment on, some skipped (first year is always attended)
+    years = np.arange(first_year, first_year + num_years)
+    attended = (years >= enroll_years[:, None]) & ((rng.random((num_participants, num_years)) < ATTEND_RATE) | (years == enroll_years[:, None]))
+    participant_idx, year_idx = np.nonzero(attended)
+    clinic = pd.DataFrame({ 'study_id': ids[participant_idx], 'redcap_event_name': pd.Series(years[year_idx]).astype(str) + '_arm_1' })
+    clinic['clinic_date'] = get_dates(years[year_idx], rng)
+    clinic['wolfram_sessionnumber'] = clinic.groupby('study_id').cumcount() + 1
+
+    missed = rng.random(len(clinic)) < MISSED_RATE
+    clinic['missed_session'] = np.where(missed, 1, np.nan)
+    clinic.loc[missed, 'clinic_date'] = pd.NaT
+    clinic['mri_date'] = clinic['clinic_date'].where(rng.random(len(clinic)) < MRI_RATE) + pd.to_timedelta(rng.integers(0, 3, len(clinic)), unit='D')
+
+    # mini-clinics (no session number)
+    has_mini = np.flatnonzero(rng.random(num_participants) < MINI_CLINIC_RATE)
+    mini = pd.DataFrame({ 'study_id': ids[has_mini], 'redcap_event_name': 'mini_clinic_1_arm_1' })
+    mini['clinic_date'] = get_dates(np.minimum(enroll_years[has_mini] + 1, first_year + num_years - 1), rng)
+
+    sessions = pd.concat([clinic, mini], ignore_index=True)
+    attended_sessions = ~sessions['missed_session'].eq(1)
+    for field in metadata:
+        name, form, field_type = field['field_name'], field['form_name'], field['field_type']
+        if form not in ['measures', 'ratings', 'symptoms']:
+            continue
+        present = attended_sessions & (rng.random(len(sessions)) >= MISSING_RATE)
+        if field_type == 'text':
+            sessions[name] = np.where(present, rng.normal(50, 10, len(sessions)).round(2), np.nan)
+        elif field_type == 'radio':
+            sessions[name] = np.where(present, rng.integers(1, CHECKBOX_OPTIONS + 1, len(sessions)), np.nan)
+        else:
+            for code in range(1, CHECKBOX_OPTIONS + 1):
+                sessions['{}___{}'.format(name, code)] = np.where(attended_sessions, (rng.random(len(sessions)) < 0.3).astype(int), np.nan)
+
+    stable = pd.DataFrame({ 'study_id': ids, 'redcap_event_name': STABLE_EVENT, 'dob': dobs, 'sex': rng.integers(1, 3, num_participants) })
+    for form in ['demographics', 'clinic_visit', 'mri', 'measures', 'ratings', 'symptoms']:
+        stable_form = form == 'demographics'
+        stable[form + '_complete'] = 2 if stable_form else np.nan
+        sessions[form + '_complete'] = np.nan if stable_form else 2
+
+    # interleave events like a REDCap export (participant order, stable event first)
+    df = pd.concat([stable, sessions], ignore_index=True)
+    df['event_order'] = np.where(df['redcap_event_name'] == STABLE_EVENT, 0, 1)
+    df = df.sort_values(['study_id', 'event_order', 'redcap_event_name'], kind='mergesort').drop(columns='event_order').reset_index(drop=True)
+
+    checkbox_cols = { field['field_name']: [ '{}___{}'.format(field['field_name'], code) for code in range(1, CHECKBOX_OPTIONS + 1) ] for field in metadata if field['field_type'] == 'checkbox' }
+    columns = ['study_id', 'redcap_event_name']
+    for form in dict.fromkeys(field['form_name'] for field in metadata):
+        columns += [ col for field in metadata if field['form_name'] == form and field['field_name'] != 'study_id' for col in checkbox_cols.get(field['field_name'], [field['field_name']]) ]
+        columns.append(form + '_complete')
+    return df[columns], metadata
+
+
+def write_export(df, metadata, output_file, dictionary_file=None):
+    df.to_csv(output_file, index=False, float_format='%g', date_format='%Y-%m-%d')
+    if dictionary_file:
+        pd.DataFrame(metadata, columns=METADATA_KEYS).to_csv(dictionary_file, index=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic Wolfram-style REDCap export (and data dictionary)')
+    parser.add_argument('output_file', help='csv file to write export to')
+    parser.add_argument('-n', '--participants', type=int, default=1000)
+    parser.add_argument('--dictionary', help='csv file to write data dictionary to')
+    parser.add_argument('--numeric', type=int, default=20, help='number of numeric clinic measures')
+    parser.add_argument('--radio', type=int, default=10, help='number of radio clinic measures')
+    parser.add_argument('--checkbox', type=int, default=5, help='number of checkbox families (each with {} options)'.format(CHECKBOX_OPTIONS))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    df, metadata = generate_export(args.participants, args.numeric, args.radio, args.checkbox, seed=args.seed)
+    write_export(df, metadata, args.output_file, args.dictionary)
+    print('Wrote {} rows ({} participants) to {}'.format(len(df), args.participants, args.output_file))
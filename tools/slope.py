@@ -1,13 +1,16 @@
-import matplotlib.pyplot as plt
 import numpy as np
 import os.path
 import pandas as pd
+import sys
 
-from gooey import Gooey, GooeyParser
-
-plt.rcParams['axes.grid'] = True
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(sys.argv[0])))) # repo root (for gooey_common/redcap_common)
+import redcap_common
+from gooey_common import Gooey, GooeyParser
 
 def plot_slope(group, x_var, outdir, groupby, save=True, plot_rmse=False):
+    import matplotlib.pyplot as plt # only needed once there is something to plot (slow to import)
+    plt.rcParams['axes.grid'] = True
+
     nrows = 2 if plot_rmse else 1
     fig, axes = plt.subplots(nrows=nrows, ncols=1, sharex=True, figsize=(12,8), squeeze=False)
 
@@ -39,7 +42,8 @@ def plot_slope(group, x_var, outdir, groupby, save=True, plot_rmse=False):
 
 
 def calc_slope(infile, x_var, outfile=None, variables=None, groupby=None, save_figs=True, plot_rmse=False):
-    df = pd.read_csv(infile, index_col=[0,1])
+    df = redcap_common.create_df(infile) # csv (can be gz/zst compressed), or parquet/feather as written by redcap_common.write_df
+    df = df.set_index(list(df.columns[:2])) # subject/session identifiers
 
     drop_cols = []
     if not groupby:
@@ -78,7 +82,11 @@ def calc_slope(infile, x_var, outfile=None, variables=None, groupby=None, save_f
     columns = ['study_id', groupby, x_var, 'variable', 'slope', 'rmse', 'nrmse', 'count']
     slope_df = pd.DataFrame(results, columns=columns).set_index(['study_id', 'variable'])
     if not outfile:
-        outfile = '{}_slopes.csv'.format(os.path.splitext(infile)[0])
+        root, ext = os.path.splitext(infile)
+        if ext in ['.gz', '.zst']:
+            root, csv_ext = os.path.splitext(root)
+            ext = csv_ext + ext
+        outfile = '{}_slopes{}'.format(root, ext) # same format as infile
 
     slope_df.groupby('variable').apply(plot_slope, x_var, os.path.dirname(outfile), groupby, save_figs, plot_rmse)
 
@@ -87,18 +95,18 @@ def calc_slope(infile, x_var, outfile=None, variables=None, groupby=None, save_f
         slope_df = slope_df.reset_index().set_index(['study_id', groupby, 'variable'])
     slope_df = slope_df.unstack().sort_index(1, level=1)
     slope_df.columns = [ '_'.join(map(str, reversed(col))) for col in slope_df.columns ]
-    slope_df.to_csv(outfile)
+    redcap_common.write_df(slope_df, outfile)
 
 
 @Gooey
 def parse_args():
     parser = GooeyParser()
     required = parser.add_argument_group('Required Arguments', gooey_options={'columns':1})
-    required.add_argument('--infile', required=True, widget='FileChooser', help='CSV file with variables of interest (assumes first 2 columns are some unique identifier for subject/session')
+    required.add_argument('--infile', required=True, widget='FileChooser', help='CSV (or parquet/feather) file with variables of interest (assumes first 2 columns are some unique identifier for subject/session')
     required.add_argument('--x_var', required=True, help='column name to use for x-axis (i.e. wolf_age)')
 
     optional = parser.add_argument_group('Optional Arguments', gooey_options={'columns':1})
-    optional.add_argument('--outfile', widget='FileChooser', help='name for outputted CSV file (default is <infile>_slope)')
+    optional.add_argument('--outfile', widget='FileChooser', help='name for outputted file -- csv, csv.gz, csv.zst, parquet or feather (default is <infile>_slopes in same format as infile)')
     optional.add_argument('--variables', nargs='+', help='variables to calculate slope for (default is all in file -- other than x_var and sub/session identifiers))')
     optional.add_argument('--groupby', help='column name to use for labelling by group in plots')
     optional.add_argument('--show_only', action='store_true', help='only show the graphs (default is to save them to file)')
@@ -0,0 +1,85 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Startup time budget (seconds) for each entry point -- time for `python <script> --headless --help` (best of several runs),
+# i.e. what a scripted batch run pays before any work is done
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BUDGET = 1.5
+STARTUP_BUDGETS = {
+    'format_wolfram_data.py': 1.5,
+    'format_track_data.py': 1.5,
+    'redcap2spss.py': 1.5,
+    'nih_toolbox_import.py': 1.5,
+    'dot_dbs_import.py': 1.5,
+    'prepare_aseba_import.py': 1.5,
+    'format_aseba_scores.py': 1.5,
+    'extract_form_fields.py': 1.5,
+    'tools/slope.py': 1.0,
+    'tools/superplot.py': 1.0,
+    'tools/extract_and_combine_volbrain.py': 1.0,
+}
+
+# modules that should only be loaded by code paths that need them
+HEAVY_MODULES = ['gooey', 'wx', 'matplotlib', 'scipy', 'redcap', 'requests']
+
+# runs script as __main__ with --headless --help, then reports which heavy modules were loaded
+CHILD_CODE = '''
+import json, runpy, sys
+script = sys.argv[1]
+sys.path.insert(0, sys.argv[2])
+sys.argv = [script, '--headless', '--help']
+try:
+    runpy.run_path(script, run_name='__main__')
+except SystemExit:
+    pass
+sys.stderr.write(json.dumps(sorted(set(m.split('.')[0] for m in sys.modules) & set({}))))
+'''.format(HEAVY_MODULES)
+
+
+# Time for `python -c "import numpy, pandas"` (best of several runs) -- the entry points import these at module level, so no script starts faster
+def time_pandas_import(runs=3):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'import numpy, pandas'], cwd=REPO_DIR, check=True)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def time_startup(script, runs=3):
+    path = os.path.join(REPO_DIR, script)
+    best, loaded, error = None, [], None
+    for _ in range(runs):
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, '-c', CHILD_CODE, path, os.path.dirname(path)], cwd=REPO_DIR, capture_output=True, text=True)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        try:
+            loaded = json.loads(proc.stderr.strip().splitlines()[-1])
+        except (IndexError, ValueError):
+            error = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else 'no output'
+    return best, loaded, error
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check startup time of each entry point against its budget (exits with 1 if any are over)')
+    parser.add_argument('--scripts', nargs='+', default=list(STARTUP_BUDGETS.keys()), help='scripts (relative to repo root) to time')
+    parser.add_argument('--runs', type=int, default=3, help='number of runs per script (best is used)')
+    args = parser.parse_args()
+
+    floor = time_pandas_import(args.runs)
+    print('{:<40} {:6.2f}s (every entry point pays this, numpy/pandas are imported at module level)'.format('import numpy, pandas', floor))
+
+    over_budget = False
+    for script in args.scripts:
+        budget = STARTUP_BUDGETS.get(script, DEFAULT_BUDGET)
+        elapsed, loaded, error = time_startup(script, args.runs)
+        status = 'ERROR ({})'.format(error) if error else ('OK' if elapsed <= budget else 'OVER BUDGET')
+        over_budget |= status != 'OK'
+        print('{:<40} {:6.2f}s (budget {:.2f}s, {:+.2f}s over pandas import) {:<12} heavy modules loaded: {}'.format(script, elapsed, budget, elapsed - floor, status, ', '.join(loaded) or 'none'))
+
+    sys.exit(1 if over_budget else 0)
@@ -1,13 +1,13 @@
 import json
-import matplotlib.pyplot as plt
 import numpy as np
 import os.path
 import pandas as pd
 import re
+import sys
 
-from gooey import Gooey, GooeyParser
-from matplotlib import lines, markers
-from scipy import stats
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(sys.argv[0])))) # repo root (for gooey_common/redcap_common)
+import redcap_common
+from gooey_common import Gooey, GooeyParser
 
 
 DEFAULT_LINE_OPTS = {
@@ -18,17 +18,17 @@ DEFAULT_MARKER_OPTS = {
     'markerfacecolor': 'white',
     'color': 'black'
 }
-LINE_STYLES = list(lines.lineStyles.keys())
-MARKER_STYLES = list(lines.Line2D.filled_markers)
 
 # helper function to build style options by iterating over possible linestyles and markers for each group
 def build_style_opts(idx):
+    from matplotlib import lines
+
     style_opts = {
         'markerstyle': {
-            'marker': MARKER_STYLES[idx]
+            'marker': list(lines.Line2D.filled_markers)[idx]
         },
         'linestyle': {
-            'linestyle': LINE_STYLES[idx]
+            'linestyle': list(lines.lineStyles.keys())[idx]
         }
     }
     style_opts['markerstyle'].update(DEFAULT_MARKER_OPTS)
@@ -37,12 +37,15 @@ def build_style_opts(idx):
    
 
 def plot_subject(data, xvar, yvar, style={}):
+    import matplotlib.pyplot as plt
+
     plt.plot(data[xvar], data[yvar], **style)
     # sns.lineplot(x=xvar, y=yvar, data=data, **style)
 
 
 def superplot(datafile, xvar, style_config=None, groupby=None, vars=[], min_pval=1, ylabel=None, outdir=None):
-    df = pd.read_csv(datafile, index_col=[0,1])
+    df = redcap_common.create_df(datafile) # csv (can be gz/zst compressed), or parquet/feather as written by redcap_common.write_df
+    df = df.set_index(list(df.columns[:2])) # subject/session identifiers
 
     style_opts = {}
     if style_config:
@@ -59,6 +62,10 @@ def superplot(datafile, xvar, style_config=None, groupby=None, vars=[], min_pval
         vars = [ col for var in vars for col in df.columns if re.search(var, col) ] # else, get dataframe columns that match column names / regexes
     
     if groupby:
+        import matplotlib.pyplot as plt # plotting libraries are slow to import, so only load them once there is something to plot
+        from matplotlib import lines
+        from scipy import stats
+
         grp = df.groupby(groupby)
 
         scatter_legend = []
@@ -106,7 +113,7 @@ def parse_args():
     parser = GooeyParser()
     
     req = parser.add_argument_group('Required arguments')
-    req.add_argument('datafile', widget='FileChooser', help='CSV file with one row per session w/ unique subject + session identifier as first 2 columns')
+    req.add_argument('datafile', widget='FileChooser', help='CSV (or parquet/feather) file with one row per session w/ unique subject + session identifier as first 2 columns')
     req.add_argument('xvar', help='columns in datafile to use on x-axis')
 
     fmt = parser.add_argument_group('Formatting options')
@@ -114,7 +121,7 @@ def parse_args():
     fmt.add_argument('--groupby', help='column in datafile to split groups on')
     fmt.add_argument('--columns', nargs='+', help='column names (or regexes) to select subset of columns to plot (default is all)')
     fmt.add_argument('--pval', type=float, default=0.05, help='only plot cross-sectional trend line if pval less than value')
-    fmt.add_argument('--ylabel', help='shared label for y-axis (i.e. mm^3, % ICV)')
+    fmt.add_argument('--ylabel', help='shared label for y-axis (i.e. mm^3, percent ICV)')
 
     opt = parser.add_argument_group('Optional arguments')
     opt.add_argument('--outdir', widget='DirChooser', help='where to store plots (default is same directory as datafile)')
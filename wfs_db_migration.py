@@ -1,8 +1,14 @@
 import argparse
+import json
 import numpy as np
 import os
 import pandas as pd
 import re
+import redcap_cache
+import redcap_common
+import redcap_profile
+
+DATA_DICTIONARY = r'H:\H\Wolfram Research Clinic\All_Data\REDCap database materials\ITRACKTrackingNeurodegeneratio_DataDictionary_2019-06-06.csv'
 
 
 def get_typed_option(opt):
@@ -36,112 +42,190 @@ def replace_values(df, change_df, index_col='new_var', verbose=False):
 
 
 def get_complete_varlist(df, varlist):
-    new_varlist = []
-    for var in varlist:
-        new_varlist += [ col for col in df.columns if col == var or col.startswith(var + '___') ]
-    return new_varlist
+    return redcap_common.ColumnIndex(df.columns).expand(varlist)
 
 
+# Merged columns are worked out on the old columns packed into a bitset (see redcap_common.pack_bits, non-zero values are set)
 def merge_columns(df, var_dict):
     for k,v in var_dict.items():
         print(k,v)
+        bits = redcap_common.pack_bits(df[v])
         if k == 'pan_chorea':
+            # 2 if either arm, plus 1 for tongue (missing if tongue is)
             chorea_arm_cols = [ col for col in v if re.search('_(l|r)', col) ]
             chorea_tng_col = [ col for col in v if col not in chorea_arm_cols ]
-            df[k] = np.where(df[chorea_arm_cols].astype(float).sum(axis=1, min_count=1) > 0, 2, 0)
-            df[k] = df.apply(lambda x: x[k] + x[chorea_tng_col].astype(float), axis=1).astype('Int64')
+            arms = redcap_common.checkbox_any(bits, v, chorea_arm_cols).fillna(False).astype(int)
+            tongue = redcap_common.checkbox_any(bits, v, chorea_tng_col).astype('Int64')
+            df[k] = (2 * arms + tongue).mask(df[chorea_tng_col].astype(float).isnull().any(axis=1))
         else:
-            df[k] = df[v].astype(float).any(axis=1)
-            df[k] = df[k].mask(pd.isnull(df[v].astype(float)).all(axis=1)).astype('Int64') # mark rows that were all null as NaN instead of False
+            df[k] = redcap_common.checkbox_any(bits, v).astype('Int64') # rows that were all null are NaN instead of False
 
         df = df.drop(columns=v)
     return df
 
 
-def migrate(data_file, var_file):
+## Migration plan -- everything migrate needs to know about the columns, worked out from the change file, data dictionary and export columns
+#   - renames, old column -> new column (checkbox fields rename each option column)
+#   - drop, columns removed after renaming (dropped variables, calc fields, and columns not in data dictionary that aren't merged)
+#   - replacements, variable -> { old value: new value }
+#   - merge_groups, new variable -> old columns merged into it
+#   - demo_columns, stable_columns, text_columns -- columns back filled, only kept on stable event, and converted to numbers where possible
+#   - plan only depends on its inputs (not on the data), so it is cached (as json) by a hash of the change file, data dictionary and export columns
+PLAN_VERSION = 2 # bump when compile_plan changes, so cached plans aren't used
+STABLE_CHAR_FORMS = [ 'patient_demographics', 'ses_related_variables', 'clinical_mutations', 'clinical_dx_summary', 'parent_wtar', 'medical_history']
+EXTRA_DROP_COLUMNS = ['mri_contraindication AND mri_other']
+
+
+def compile_plan(columns, change_df, schema):
+    # get columns that will need to merged (should be exluded from renaming step)
+    merge_dict = change_df[pd.notnull(change_df['merge_var'])].groupby('merge_var')['old_var'].apply(list).to_dict()
+    merge_cols = set(item for sublist in merge_dict.values() for item in sublist)
+
+    # change variable names
+    columns = redcap_common.ColumnIndex(columns)
+    checkbox_cols = set(redcap_cache.get_fields_of_type(schema, 'checkbox'))
+    change_df = change_df.assign(new_var=change_df['new_var'].fillna(change_df['old_var']))
+    rename_map = {}
+    for old_var, new_var in change_df.loc[pd.notnull(change_df['new_var']), ['old_var', 'new_var']].itertuples(index=False):
+        if new_var in merge_dict.keys():
+            continue
+
+        # if checkbox, then iterate over all matching columns to create rename map entries
+        if new_var in checkbox_cols:
+            for col in columns.get_options(old_var):
+                rename_map[col] = col.replace(old_var, new_var)
+        else:
+            rename_map[old_var] = new_var
+    columns.rename(rename_map)
+
+    # get columns to drop
+    drop_vars = change_df[change_df['drop'] == 1]['new_var'].values
+    drop_cols = columns.expand(drop_vars)
+    drop_cols += [ col for col in redcap_cache.get_fields_of_type(schema, 'calc') if col in columns ]
+    drop_cols += [ col for col in columns.columns if col not in schema['field_types'] and col not in merge_cols ]
+    drop_cols = list(dict.fromkeys(drop_cols))
+    columns.drop(drop_cols)
+
+    # replace variable values
+    replacements = {}
+    replace_change_df = change_df.set_index('new_var')
+    for var in change_df.dropna(subset=['opt_replacements'])['new_var'].values:
+        if var in columns:
+            replacements[var] = get_data_dict_options_map(replace_change_df, var)
+    columns.drop(EXTRA_DROP_COLUMNS)
+
+    # merged columns are added (at the end, if new) and the columns they came from removed
+    for k, v in merge_dict.items():
+        columns.add(k)
+        columns.drop(v)
+
+    stable_columns = [ form + '_complete' for form in STABLE_CHAR_FORMS if form + '_complete' in columns ] + \
+        columns.expand([ field for form in STABLE_CHAR_FORMS for field in schema['form_fields'].get(form, []) ])
+
+    return {
+        'renames': rename_map,
+        'drop': drop_cols,
+        'replacements': replacements,
+        'merge_groups': merge_dict,
+        'demo_columns': columns.expand(schema['form_fields'].get('patient_demographics', [])),
+        'stable_columns': stable_columns,
+        'text_columns': [ col for col in columns.expand(redcap_cache.get_fields_of_type(schema, 'text')) if not col.startswith('compass31') ],
+    }
+
+
+def get_plan_file(var_file, schema, columns, cache_dir=redcap_cache.CACHE_DIR):
+    key = redcap_cache.get_content_key('migration_plan', PLAN_VERSION, redcap_cache.hash_file(var_file), schema['version'], list(columns))
+    return os.path.join(cache_dir, key + '.plan.json')
+
+
+# Cached plan for export columns (compiled and saved if change file, data dictionary or columns are new)
+def get_plan(var_file, schema, columns):
+    plan_file = get_plan_file(var_file, schema, columns)
+    if os.path.exists(plan_file):
+        print('### Using cached migration plan {} ###'.format(plan_file))
+        with open(plan_file) as f:
+            return json.load(f)
+
+    plan = compile_plan(list(columns), pd.read_csv(var_file), schema)
+    if not os.path.exists(os.path.dirname(plan_file)):
+        os.makedirs(os.path.dirname(plan_file))
+    with open(plan_file, 'w') as f:
+        json.dump(plan, f, indent=1)
+    return plan
+
+
+def migrate(data_file, var_file, profile=False):
     for (datafile, varfile) in zip(data_file, var_file):
         print(datafile, varfile)
-        df = pd.read_csv(datafile, dtype=object)
-        df = df[df['study_id'].str.contains(r'WOLF_\d{4}_.+')] # remove Test and Wolf_AN rows # FIXME
-        df['redcap_event_name'] = df['redcap_event_name'].str.replace('wolframclinic_', '')
-        df = df.set_index(['study_id', 'redcap_event_name']).dropna(how='all')
-        change_df = pd.read_csv(varfile)
-        dd_df = pd.read_csv(r'H:\H\Wolfram Research Clinic\All_Data\REDCap database materials\ITRACKTrackingNeurodegeneratio_DataDictionary_2019-06-06.csv')
-
-        # get columns that will need to merged (should be exluded from renaming step)
-        merge_dict = change_df[pd.notnull(change_df['merge_var'])].groupby('merge_var')['old_var'].apply(list).to_dict()
-        merge_cols = [ item for sublist in merge_dict.values() for item in sublist ]
-        print(merge_dict)
-        print('pan_choreiform_invol_mov_right' in df.columns)
-
-        # change variable names
-        checkbox_cols = dd_df[dd_df['Field Type'] == 'checkbox']['Variable / Field Name'].values
-        change_df['new_var'] = change_df['new_var'].fillna(change_df['old_var'])
-        rename_map = {}
-        for idx, row in change_df[pd.notnull(change_df['new_var'])].iterrows():
-            if row['new_var'] in merge_dict.keys():
-                continue
-
-            # if checkbox, then iterate over all matching columns to create rename map entries
-            if row['new_var'] in checkbox_cols:
-                var_cols = [ col for col in df.columns if col.startswith(row['old_var'] + '___')]
-                for col in var_cols:
-                    rename_map[col] = col.replace(row['old_var'], row['new_var'])
-            else:
-                rename_map[row['old_var']] = row['new_var']
-        df = df.rename(columns=rename_map)
-
-        # get columns to drop
-        drop_vars = change_df[change_df['drop'] == 1]['new_var'].values
-        drop_cols = []
-        for var in drop_vars:
-            drop_cols += [ col for col in df.columns if col == var or col.startswith(var + '___') ]
-        drop_cols += list(dd_df[dd_df['Field Type'] == 'calc']['Variable / Field Name'].values)
-        drop_cols += [ col for col in df.columns if col not in dd_df['Variable / Field Name'].values and col not in merge_cols ]
-        df = df.drop(columns=drop_cols, errors='ignore')
-
-        # replace variable values
-        df = replace_values(df, change_df)
-
-        df = df.drop(columns=['mri_contraindication AND mri_other'], errors='ignore')
-
-        # merge L/R that are now overall y/n
-        df = merge_columns(df, merge_dict)
-
-        ## Handle stable_char special cases
-
-        # backfill stable demographic information
-        demo_vars = get_complete_varlist(df, dd_df[dd_df['Form Name'] == 'patient_demographics']['Variable / Field Name'].values)
-        df[demo_vars] = df.groupby('study_id')[demo_vars].apply(lambda x: x.bfill()) # back fill demographics form
-
-        stable_char_forms = [ 'patient_demographics', 'ses_related_variables', 'clinical_mutations', 'clinical_dx_summary', 'parent_wtar', 'medical_history']
-        stable_vars = [ form + '_complete' for form in stable_char_forms if form + '_complete' in df.columns ] + \
-            get_complete_varlist(df, dd_df[dd_df['Form Name'].isin(stable_char_forms)]['Variable / Field Name'].values)
-
-        df.loc[~df.index.isin(['stable_patient_cha_arm_1'], level=1), stable_vars] = np.nan
-
-        text_cols = get_complete_varlist(df, dd_df[dd_df['Field Type'] == 'text']['Variable / Field Name'].values)
-        for col in text_cols:
-            try:
-                if pd.to_numeric(df[col], errors='coerce').isnull().all() or col.startswith('compass31'):
-                    continue
-                df[col] = pd.to_numeric(df[col], errors='coerce')
-                if all(x.is_integer() or pd.isnull(x) for x in df[col]):
-                    df[col] = df[col].astype('Int64')
-            except TypeError as e:
-                print(col, e)
-                pass
-
-        df.dropna(how='all').to_csv('{}_migration.csv'.format(os.path.splitext(datafile)[0]))
+        profiler = redcap_profile.Profiler(profile)
+        with profiler.stage('load') as stage:
+            schema = redcap_cache.read_data_dictionary(DATA_DICTIONARY)
+            df = redcap_common.create_df(datafile, schema, strings=True, report=True) # ids/events as categories, everything else text
+            stage.output(df)
+
+        with profiler.stage('filter', df) as stage:
+            df = df[df['study_id'].str.contains(r'WOLF_\d{4}_.+')] # remove Test and Wolf_AN rows # FIXME
+            df['redcap_event_name'] = df['redcap_event_name'].str.replace('wolframclinic_', '')
+            df = df.set_index(['study_id', 'redcap_event_name']).dropna(how='all')
+            stage.output(df)
+
+        with profiler.stage('plan', df) as stage:
+            plan = get_plan(varfile, schema, df.columns)
+
+        with profiler.stage('rename', df) as stage:
+            df = stage.output(df.rename(columns=plan['renames']))
+
+        with profiler.stage('drop', df) as stage:
+            df = stage.output(df.drop(columns=plan['drop']))
+
+        with profiler.stage('replace_values', df) as stage:
+            # replace variable values
+            df = df.replace(plan['replacements']) if plan['replacements'] else df
+            df = df.drop(columns=EXTRA_DROP_COLUMNS, errors='ignore')
+            stage.output(df)
+
+        with profiler.stage('merge', df) as stage:
+            # merge L/R that are now overall y/n
+            df = merge_columns(df, plan['merge_groups'])
+            stage.output(df)
+
+        with profiler.stage('stable', df) as stage:
+            ## Handle stable_char special cases
+
+            # backfill stable demographic information
+            demo_vars = plan['demo_columns']
+            df[demo_vars] = df.groupby('study_id')[demo_vars].bfill() # back fill demographics form
+            df.loc[~df.index.isin(['stable_patient_cha_arm_1'], level=1), plan['stable_columns']] = np.nan
+            stage.output(df)
+
+        with profiler.stage('numeric', df) as stage:
+            for col in plan['text_columns']:
+                try:
+                    values = pd.to_numeric(df[col], errors='coerce')
+                    if values.isnull().all():
+                        continue
+                    df[col] = values
+                    if (values.dropna() % 1 == 0).all():
+                        df[col] = df[col].astype('Int64')
+                except TypeError as e:
+                    print(col, e)
+                    pass
+            stage.output(df)
+
+        output_file = '{}_migration.csv'.format(os.path.splitext(datafile)[0])
+        with profiler.stage('write', df):
+            df.dropna(how='all').to_csv(output_file)
+        profiler.write(output_file)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--datafile', nargs='+', required=True)
     parser.add_argument('--varfile', nargs='+', required=True)
+    parser.add_argument('--profile', action='store_true', help='record time/memory for each migration stage (written next to output as <output>_profile.json/.csv)')
     args = parser.parse_args()
 
     if len(args.datafile) != len(args.varfile):
         parser.error('Must provide equal number of data and variable files')
 
-    migrate(args.datafile, args.varfile)
+    migrate(args.datafile, args.varfile, args.profile)